@@ -1,23 +1,18 @@
-import json
-import requests
 from config import Config
+from completions_client import CompletionsClient, CompletionsError
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint. Requests are hedged: one
+# that is slower than usual is sent again, and the first answer wins
+client = CompletionsClient(config, hedging=True)
 
 # --------------------------------------------------------------
 # Add your own prompt
 # --------------------------------------------------------------
 
-# Define the headers and payload
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
-
 # Get user input for the prompt
 prompt = input("Enter your prompt: ")
 payload = {
@@ -33,26 +28,14 @@ payload = {
 }
 
 # Send the request to the completions endpoint
-response = requests.post(
-    config.completions,
-    headers=headers,
-    json=payload
-)
+try:
+    response_data = client.post(payload)
+    content = client.extract_content(response_data)
 
-# Extract and print only the message content in a readable format
-if response.status_code == 200:
-    response_data = response.json()
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        message = response_data['choices'][0].get('message', {})
-        content = message.get('content', '')
-        
-        # Format and print the content nicely
-        print("\n" + "="*80 + "\n")
-        print(f"RESPONSE TO: '{prompt}'\n")
-        print(content)
-        print("\n" + "="*80)
-    else:
-        print("No message content found in the response")
-else:
-    print(f"Error: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+    # Format and print the content nicely
+    print("\n" + "="*80 + "\n")
+    print(f"RESPONSE TO: '{prompt}'\n")
+    print(content)
+    print("\n" + "="*80)
+except CompletionsError as e:
+    print(e)
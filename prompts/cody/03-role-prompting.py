@@ -1,23 +1,17 @@
-import json
-import requests
 from config import Config
+from completions_client import CompletionsClient, CompletionsError
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint
+client = CompletionsClient(config)
 
 # --------------------------------------------------------------
 # Example with different roles in the chat completions API
 # --------------------------------------------------------------
 
-# Define the headers and payload
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
-
 # Use multiple messages with different roles
 payload = {
     'model': config.model,
@@ -36,26 +30,14 @@ payload = {
 }
 
 # Send the request to the completions endpoint
-response = requests.post(
-    config.completions,
-    headers=headers,
-    json=payload
-)
+try:
+    response_data = client.post(payload)
+    content = client.extract_content(response_data)
 
-# Extract and print the response
-if response.status_code == 200:
-    response_data = response.json()
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        message = response_data['choices'][0].get('message', {})
-        content = message.get('content', '')
-        
-        # Format and print the content nicely
-        print("\n" + "="*80 + "\n")
-        print("PIRATE ASSISTANT RESPONDS ABOUT ASYNC/AWAIT:\n")
-        print(content)
-        print("\n" + "="*80)
-    else:
-        print("No message content found in the response")
-else:
-    print(f"Error: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+    # Format and print the content nicely
+    print("\n" + "="*80 + "\n")
+    print("PIRATE ASSISTANT RESPONDS ABOUT ASYNC/AWAIT:\n")
+    print(content)
+    print("\n" + "="*80)
+except CompletionsError as e:
+    print(e)
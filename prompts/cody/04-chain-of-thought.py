@@ -1,23 +1,18 @@
-import json
-import requests
+import sys
 from config import Config
+from completions_client import CompletionsClient, CompletionsError
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint
+client = CompletionsClient(config)
 
 # --------------------------------------------------------------
 # Chain-of-Thought Prompting Example
 # --------------------------------------------------------------
 
-# Define the headers and payload
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
-
 # Chain-of-Thought prompting for complex reasoning
 payload = {
     'model': config.model,
@@ -46,27 +41,13 @@ What type is each person (Truth-teller, Liar, or Alternator)? Analyze all possib
     ]
 }
 
-# Send the request to the completions endpoint
-response = requests.post(
-    config.completions,
-    headers=headers,
-    json=payload
-)
-
-# Extract and print the response
-if response.status_code == 200:
-    response_data = response.json()
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        message = response_data['choices'][0].get('message', {})
-        content = message.get('content', '')
-        
-        # Format and print the content nicely
-        print("\n" + "="*80 + "\n")
-        print("CHAIN-OF-THOUGHT REASONING FOR LOGICAL PUZZLE:\n")
-        print(content)
-        print("\n" + "="*80)
-    else:
-        print("No message content found in the response")
-else:
-    print(f"Error: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+# Stream the response so tokens are printed as soon as they are generated
+try:
+    print("\n" + "="*80 + "\n")
+    print("CHAIN-OF-THOUGHT REASONING FOR LOGICAL PUZZLE:\n")
+    content, stats = client.stream(payload, out=sys.stdout)
+    print("\n\n" + "="*80)
+    print(f"Time to first token: {stats.time_to_first_token:.2f}s | "
+          f"{stats.tokens} tokens at {stats.tokens_per_second:.1f} tokens/sec")
+except CompletionsError as e:
+    print(e)
@@ -1,22 +1,43 @@
-import json
-import requests
 from config import Config
+from few_shot_store import FewShotStore
+from prompt_manager import PromptManager
+from completions_client import CompletionsClient, CompletionsError
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint
+client = CompletionsClient(config)
 
 # --------------------------------------------------------------
 # Few-Shot Prompting Example
 # --------------------------------------------------------------
 
-# Define the headers and payload
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
+# Labelled examples to draw from. In practice this store holds thousands of
+# examples; only the ones most similar to the query are put in the prompt.
+example_store = FewShotStore([
+    ("The food was amazing and the service was excellent!", "Positive"),
+    ("I waited for an hour and the food was cold when it arrived.", "Negative"),
+    ("The restaurant was clean and the prices were reasonable.", "Positive"),
+    ("Our waiter was friendly, although the pasta was just okay.", "Neutral"),
+    ("The staff was rude and the dessert was stale.", "Negative"),
+    ("Decent food, nothing special, but the staff was friendly.", "Neutral"),
+    ("Best pizza in town, we will definitely come back.", "Positive"),
+    ("The music was far too loud and the portions were tiny.", "Negative"),
+])
+
+query = "The staff was friendly but the food was mediocre at best."
+examples = example_store.select(query, k=3)
+
+# Render the prompt with only the selected examples
+prompt = PromptManager.get_prompt(
+    'few_shot',
+    instruction='Analyze the sentiment of the following reviews as positive, negative, or neutral:',
+    examples=examples,
+    label_name='Sentiment',
+    query=query,
+)
 
 # Few-shot prompting provides examples to guide the model's responses
 payload = {
@@ -30,43 +51,20 @@ payload = {
         },
         {
             'role': 'user',
-            'content': """Analyze the sentiment of the following reviews as positive, negative, or neutral:
-
-Example 1: "The food was amazing and the service was excellent!" 
-Sentiment: Positive
-
-Example 2: "I waited for an hour and the food was cold when it arrived."
-Sentiment: Negative
-
-Example 3: "The restaurant was clean and the prices were reasonable."
-Sentiment: Positive
-
-Now analyze: "The staff was friendly but the food was mediocre at best."""
+            'content': prompt
         }
     ]
 }
 
 # Send the request to the completions endpoint
-response = requests.post(
-    config.completions,
-    headers=headers,
-    json=payload
-)
+try:
+    response_data = client.post(payload)
+    content = client.extract_content(response_data)
 
-# Extract and print the response
-if response.status_code == 200:
-    response_data = response.json()
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        message = response_data['choices'][0].get('message', {})
-        content = message.get('content', '')
-        
-        # Format and print the content nicely
-        print("\n" + "="*80 + "\n")
-        print("FEW-SHOT PROMPTING RESULT:\n")
-        print(content)
-        print("\n" + "="*80)
-    else:
-        print("No message content found in the response")
-else:
-    print(f"Error: {response.status_code}")
-    print(response.text)
\ No newline at end of file
+    # Format and print the content nicely
+    print("\n" + "="*80 + "\n")
+    print("FEW-SHOT PROMPTING RESULT:\n")
+    print(content)
+    print("\n" + "="*80)
+except CompletionsError as e:
+    print(e)
@@ -1,41 +1,25 @@
-import json
-import requests
-import os
-from jinja2 import Environment, FileSystemLoader
 from config import Config
+from completions_client import CompletionsClient, CompletionsError
+from prompt_manager import PromptManager
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint
+client = CompletionsClient(config)
 
 # --------------------------------------------------------------
 # Prompt management with Jinja2 templates stored in external files
 # --------------------------------------------------------------
 
-# Define the headers for API requests
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
-
-# Set up Jinja2 environment to load templates from files
-template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-environment = Environment(loader=FileSystemLoader(template_dir))
-template = environment.get_template('prompts.j2')
+# prompts.j2 is a macro library: PromptManager loads it once and looks the
+# macros up by name (concept, language, pattern)
 
 # Function to get AI response using a rendered template
 def get_ai_response(template_name, template_vars):
-    # Get the macro from the template based on the type
-    if template_name == 'concept':
-        rendered_prompt = template.module.concept(template_vars['topic'], template_vars.get('conciseness', False))
-    elif template_name == 'language':
-        rendered_prompt = template.module.language(template_vars['topic'], template_vars.get('conciseness', False))
-    elif template_name == 'pattern':
-        rendered_prompt = template.module.pattern(template_vars['topic'], template_vars.get('conciseness', False))
-    else:
-        raise ValueError(f"Unknown template type: {template_name}")
+    # Render the macro for the selected type
+    rendered_prompt = PromptManager.render_macro('prompts', template_name, **template_vars)
     
     # Create the payload with the rendered prompt
     payload = {
@@ -50,24 +34,11 @@ def get_ai_response(template_name, template_vars):
         ]
     }
     
-    # Send the request to the completions endpoint
-    response = requests.post(
-        config.completions,
-        headers=headers,
-        json=payload
-    )
-    
-    # Extract and return the response
-    if response.status_code == 200:
-        response_data = response.json()
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            message = response_data['choices'][0].get('message', {})
-            content = message.get('content', '')
-            return content
-        else:
-            return "No message content found in the response"
-    else:
-        return f"Error: {response.status_code}\n{response.text}"
+    # Send the request to the completions endpoint and return the content
+    try:
+        return client.extract_content(client.post(payload))
+    except CompletionsError as e:
+        return str(e)
 
 # Example 1: Ask about a programming concept
 concept_vars = {
@@ -127,12 +98,7 @@ print("\nThe template-rendered prompt that was sent:")
 print("-"*50)
 
 # Get the rendered template based on the type
-if template_name == 'concept':
-    rendered_prompt = template.module.concept(template_vars['topic'], template_vars.get('conciseness', False))
-elif template_name == 'language':
-    rendered_prompt = template.module.language(template_vars['topic'], template_vars.get('conciseness', False))
-elif template_name == 'pattern':
-    rendered_prompt = template.module.pattern(template_vars['topic'], template_vars.get('conciseness', False))
+rendered_prompt = PromptManager.render_macro('prompts', template_name, **template_vars)
 
 print(rendered_prompt)
 print("-"*50)
\ No newline at end of file
@@ -1,25 +1,22 @@
-import json
-import requests
-import os
+import asyncio
+import sys
 from config import Config
+from completions_client import AsyncCompletionsClient, CompletionsClient, CompletionsError
 from prompt_manager import PromptManager
+from structured_output import StructuredOutputError
 
 # Initialize configuration
 config = Config()
 # Validate that all required configuration values are present
 config.validate()
+# Pooled HTTP client for the completions endpoint. Requests are hedged: one
+# that is slower than usual is sent again, and the first answer wins
+client = CompletionsClient(config, hedging=True)
 
 # --------------------------------------------------------------
 # Using the PromptManager with the ticket_analysis template
 # --------------------------------------------------------------
 
-# Define the headers for API requests
-headers = {
-    'Authorization': config.sg_token,
-    'X-Requested-With': config.x_requested_with,
-    'Content-Type': 'application/json'
-}
-
 # Example ticket data - we'll provide options for the user to choose from
 example_tickets = {
     'helpdesk': {
@@ -63,42 +60,91 @@ Please refund the duplicate charge as soon as possible. My account number is TG-
 def get_ai_response(template_name, template_vars):
     # Get the rendered prompt using PromptManager
     try:
-        rendered_prompt = PromptManager.get_prompt(template_name, **template_vars)
+        # Overlong variables are cut down per the template's budget policy and
+        # max_tokens is fitted to the model's context window. The static
+        # preamble (persona, context, task) is rendered once and cached; only
+        # the ticket itself is rendered per call
+        rendered = PromptManager.render_split(
+            template_name, context_window=config.context_window, **template_vars
+        )
         
-        # Create the payload with the rendered prompt
+        # Create the payload: the shared preamble as a system message, the
+        # ticket as the user message
         payload = {
             'model': config.model,
             'temperature': 0.1,
-            'max_tokens': 1000,
-            'messages': [
-                {
-                    'role': 'user',
-                    'content': rendered_prompt
-                }
-            ]
+            'max_tokens': rendered.max_tokens,
+            'messages': rendered.messages()
         }
         
-        # Send the request to the completions endpoint
-        response = requests.post(
-            config.completions,
-            headers=headers,
-            json=payload
-        )
-        
-        # Extract and return the response
-        if response.status_code == 200:
-            response_data = response.json()
-            if 'choices' in response_data and len(response_data['choices']) > 0:
-                message = response_data['choices'][0].get('message', {})
-                content = message.get('content', '')
-                return content
-            else:
-                return "No message content found in the response"
-        else:
-            return f"Error: {response.status_code}\n{response.text}"
+        # Send the request to the completions endpoint and return the content
+        return client.extract_content(client.post(payload, template=template_name))
+    except CompletionsError as e:
+        return str(e)
     except Exception as e:
         return f"Error rendering template: {str(e)}"
 
+# Async variant for ticket backlogs: renders each ticket and yields
+# (index, content) as responses arrive, with at most `concurrency` requests
+# in flight at once
+async def get_ai_responses(template_name, template_vars_list, concurrency=10):
+    def payloads():
+        for template_vars in template_vars_list:
+            try:
+                rendered = PromptManager.render_split(
+                    template_name, context_window=config.context_window, **template_vars
+                )
+            except ValueError as e:
+                # complete_many passes the error through as this ticket's result
+                yield e
+                continue
+            yield {
+                'model': config.model,
+                'temperature': 0.1,
+                'max_tokens': rendered.max_tokens,
+                'messages': rendered.messages()
+            }
+
+    async with AsyncCompletionsClient(config, concurrency=concurrency) as async_client:
+        async for index, result in async_client.complete_many(payloads(), template=template_name):
+            yield index, str(result)
+
+# Structured variant: the template's output_schema asks for a JSON answer,
+# which is parsed while it streams. Routing can act on intent and confidence
+# as soon as each one is complete, and the stream is closed once both are in,
+# without waiting for (or paying for) the reasoning
+def route_ticket(template_name, template_vars):
+    rendered = PromptManager.render_split(
+        template_name, context_window=config.context_window, structured=True, **template_vars
+    )
+    payload = {
+        'model': config.model,
+        'temperature': 0.1,
+        'max_tokens': rendered.max_tokens,
+        'messages': rendered.messages()
+    }
+    schema = PromptManager.get_metadata(template_name)['output_schema']
+
+    def on_field(name, value):
+        print(f"  {name}: {value}")
+
+    try:
+        result = client.stream_structured(payload, schema, on_field=on_field, template=template_name)
+    except (CompletionsError, StructuredOutputError) as e:
+        print(f"  Error: {e}")
+        return
+    queue = 'triage' if result.fields['confidence'] < 0.7 else result.fields['intent']
+    print(f"Routed to: {queue} ({result.stats.total_time:.2f}s, stream closed early: {result.cancelled})")
+
+async def analyze_all_tickets():
+    ticket_types = list(example_tickets)
+    template_vars_list = [example_tickets[ticket_type] for ticket_type in ticket_types]
+    async for index, content in get_ai_responses('ticket_analysis', template_vars_list):
+        print("\n" + "="*80 + "\n")
+        print(f"TICKET ANALYSIS FOR: {ticket_types[index]}\n")
+        print(content)
+    print("\n" + "="*80)
+
 # Get information about the template
 template_info = PromptManager.get_template_info('ticket_analysis')
 
@@ -114,8 +160,20 @@ print("Select a ticket type to analyze:")
 print("1. Internal Helpdesk Ticket (IT access issue)")
 print("2. Customer Support Ticket (Product issue)")
 print("3. Billing Support Ticket (Double charge)")
+print("4. All of the above, analyzed concurrently")
+print("5. All of the above, routed on structured output as it streams")
+
+choice = input("Enter your choice (1-5): ")
+
+if choice == '4':
+    asyncio.run(analyze_all_tickets())
+    sys.exit(0)
 
-choice = input("Enter your choice (1-3): ")
+if choice == '5':
+    for ticket_type, template_vars in example_tickets.items():
+        print(f"\nROUTING: {ticket_type}")
+        route_ticket('ticket_analysis', template_vars)
+    sys.exit(0)
 
 # Set the template variables based on the user's choice
 if choice == '1':
@@ -142,7 +200,9 @@ print(content)
 print("\n" + "="*80)
 
 # Show the actual prompt that was sent (for educational purposes)
+rendered = PromptManager.render_split('ticket_analysis', **template_vars)
 print("\nThe template-rendered prompt that was sent:")
 print("-"*80)
-print(PromptManager.get_prompt('ticket_analysis', **template_vars))
+print(f"[system]\n{rendered.prefix}\n")
+print(f"[user]\n{rendered.text}")
 print("-"*80)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import asyncio
+import time
+from config import Config
+from completions_client import AsyncCompletionsClient
+from tree_of_thoughts import TreeOfThoughts
+
+# Initialize configuration
+config = Config()
+# Validate that all required configuration values are present
+config.validate()
+
+# --------------------------------------------------------------
+# Tree of Thoughts with concurrent branches
+# --------------------------------------------------------------
+# Instead of asking the model to invent and judge three approaches inside a
+# single long answer (see 05-tree-of-thoughts.py), every candidate thought is
+# its own request. Candidates of a level are generated and scored in parallel,
+# the best ones are kept (the beam) and expanded again at the next level.
+
+problem = 'What would be the best way to reduce traffic congestion in a growing city?'
+
+async def main():
+    async with AsyncCompletionsClient(config, concurrency=12) as client:
+        tree = TreeOfThoughts(
+            client,
+            breadth=3,          # candidate thoughts generated per kept node
+            depth=2,            # levels of the tree
+            beam_width=2,       # nodes kept after scoring each level
+            token_budget=20000, # estimated tokens this tree may spend
+            temperature=0.7,    # higher temperature for more diverse thoughts
+        )
+        start = time.perf_counter()
+        result = await tree.solve(problem)
+        elapsed = time.perf_counter() - start
+
+    print("\n" + "="*80 + "\n")
+    print("PARALLEL TREE OF THOUGHTS:\n")
+    print(f"Best line of reasoning (score {result.best.score:.0f}/10):")
+    for number, step in enumerate(result.best.steps, 1):
+        print(f"  Step {number}: {step}")
+    print("\nFinal recommendation:\n")
+    print(result.answer or "No final answer (token budget exhausted or request failed)")
+    print("\n" + "="*80)
+    print(f"{result.levels} levels, {result.requests} requests, "
+          f"~{result.tokens_used} tokens reserved, {elapsed:.2f}s")
+
+asyncio.run(main())
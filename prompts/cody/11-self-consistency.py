@@ -0,0 +1,49 @@
+import asyncio
+from config import Config
+from completions_client import AsyncCompletionsClient
+from self_consistency import SelfConsistency
+
+# Initialize configuration
+config = Config()
+# Validate that all required configuration values are present
+config.validate()
+
+# --------------------------------------------------------------
+# Self-consistency: sample several reasoning paths and vote
+# --------------------------------------------------------------
+# The zero-shot chain-of-thought prompt from 07-zero-shot-cot.py is sampled
+# several times at a higher temperature. The final answer of each reasoning
+# path is extracted and the most common answer wins. Sampling stops early
+# once one answer leads by `vote_margin` votes.
+
+messages = [
+    {
+        'role': 'assistant',
+        'content': 'You are a helpful assistant that solves problems carefully. End your reply with a line of the form "Final answer: <answer>".'
+    },
+    {
+        'role': 'user',
+        'content': 'If John has 5 pears, then eats 2, and buys 5 more, then gives 3 to his friend, how many pears does he have? Let\'s think through this step by step.'
+    }
+]
+
+async def main():
+    async with AsyncCompletionsClient(config, concurrency=5) as client:
+        voter = SelfConsistency(
+            client,
+            samples=9,          # maximum number of reasoning paths
+            parallel=3,         # paths sampled at the same time
+            temperature=0.7,    # diverse reasoning paths
+            parser='final_answer',
+            vote_margin=3,      # stop once an answer leads by this many votes
+        )
+        return await voter.run(messages)
+
+result = asyncio.run(main())
+
+print("\n" + "="*80 + "\n")
+print("SELF-CONSISTENCY CHAIN-OF-THOUGHT:\n")
+print(f"Answer: {result.answer}")
+print(f"Votes: {result.votes}")
+print(f"Samples used: {result.samples}{' (stopped early)' if result.stopped_early else ''}")
+print("\n" + "="*80)
@@ -0,0 +1,606 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from array import array
+from collections import namedtuple
+from itertools import islice
+from config import Config
+from completions_client import AsyncCompletionsClient
+from instrumentation import MetricsAggregator, instrumentation
+from prompt_manager import PromptManager
+
+# --------------------------------------------------------------
+# Offline batch runner: JSONL in, JSONL out, resumable
+# --------------------------------------------------------------
+# Each input line is a JSON object of template variables, e.g. a ticket for
+# ticket_analysis. Rows are rendered lazily, sent concurrently and written to
+# the output as they complete, one JSON object per line:
+#   {"index": 12, "id": ..., "output": "...", "error": null}
+# A line that isn't a JSON object gets a record with its error, like a row
+# that fails to render; blank lines are skipped.
+#
+# Progress is checkpointed next to the output. After a crash the same command
+# resumes: completed rows (including any written after the last checkpoint)
+# are skipped and only the rest are sent. Rows whose request still failed
+# after retries (429, 5xx, connection errors) aren't written; they are kept
+# in the checkpoint and sent again by the next run.
+#
+#   python batch_runner.py ticket_analysis tickets.jsonl results.jsonl --concurrency 20
+#
+# With --processes, rendering, requests and response post-processing run in
+# worker processes instead, so CPU-bound work isn't serialized by one GIL.
+# Each worker keeps a warmed PromptManager and its own HTTP pool, and pulls
+# chunks of rows from a shared queue for as long as the run lasts. It works
+# on two chunks at a time, so when one is down to a slow or retrying row the
+# next one's rows keep its request slots busy. A chunk goes out as one blob
+# of raw input lines and comes back as one blob of finished output lines, so
+# nothing is pickled per row.
+#
+#   python batch_runner.py ticket_analysis tickets.jsonl results.jsonl --processes 4 --concurrency 10
+#
+# With --pack, rows of a template with a packing policy are answered several
+# to a request (see request_packing.py); output records are the same.
+#
+# With --dedup-index, rows that are near-duplicates of a row answered before
+# or already on its way (same pipeline, Jaccard similarity of the ticket text
+# above --dedup-threshold) reuse that answer instead of being sent; see
+# near_duplicates.py. Their records add "duplicate_of" (the earlier row's id)
+# and "similarity". The index is saved to the given path when the run ends
+# and picked up again by the next run.
+#
+#   python batch_runner.py ticket_analysis tickets.jsonl results.jsonl --dedup-index tickets.lsh.npz
+
+class Checkpoint:
+    # Rows below `watermark` are all done; `done` holds finished rows above it.
+    # Because only a bounded window of rows is in flight, `done` stays small
+    # and the checkpoint size doesn't grow with the input. `failed` holds rows
+    # whose request failed transiently: the watermark moves past them, but
+    # they aren't done and the next run sends them again.
+    def __init__(self, path, watermark=0, done=None, offset=0, failed=None):
+        self.path = path
+        self.watermark = watermark
+        self.done = set(done or ())
+        self.offset = offset
+        self.failed = set(failed or ())
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return cls(path)
+        return cls(path, data['watermark'], data['done'], data['offset'], data.get('failed'))
+
+    def is_done(self, index):
+        return index not in self.failed and (index < self.watermark or index in self.done)
+
+    def mark_done(self, index):
+        self.failed.discard(index)
+        if index < self.watermark:
+            # A failed row sent again; the watermark is already past it
+            return
+        self.done.add(index)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def mark_failed(self, index):
+        self.mark_done(index)
+        self.failed.add(index)
+
+    def save(self, offset):
+        self.offset = offset
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({
+                'watermark': self.watermark,
+                'done': sorted(self.done),
+                'offset': offset,
+                'failed': sorted(self.failed),
+            }, file)
+        os.replace(tmp_path, self.path)
+
+def recover_output(output_path, checkpoint):
+    # Rows written after the last checkpoint are still complete results:
+    # record them as done and drop a partially written trailing line
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, 'rb+') as file:
+        file.seek(checkpoint.offset)
+        offset = checkpoint.offset
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                checkpoint.mark_done(json.loads(line)['index'])
+            except (ValueError, KeyError):
+                break
+            offset += len(line)
+        file.truncate(offset)
+    return offset
+
+def read_lines(input_path, checkpoint):
+    # Streams the raw input one line at a time, so memory use is independent of file size
+    with open(input_path, 'rb') as file:
+        for index, line in enumerate(file):
+            if checkpoint.is_done(index):
+                continue
+            if not line.strip():
+                # Nothing to send, but done all the same, so the watermark moves past it
+                checkpoint.mark_done(index)
+                continue
+            yield index, line
+
+def parse_row(line):
+    # The template variables of one input line, or the error recorded for it
+    # when it isn't a JSON object; iter_results fails such rows without a request
+    try:
+        row = json.loads(line)
+    except ValueError as e:
+        return ValueError(f"Invalid JSON input line: {e}")
+    if not isinstance(row, dict):
+        return ValueError(f"Input line is not a JSON object: {type(row).__name__}")
+    return row
+
+def row_id(row):
+    return row.get('id') if isinstance(row, dict) else None
+
+def read_rows(input_path, checkpoint):
+    for index, line in read_lines(input_path, checkpoint):
+        yield index, parse_row(line)
+
+def read_chunks(input_path, checkpoint, chunk_size):
+    # Groups pending lines into (indices, blob) pairs for the worker processes
+    indices = array('q')
+    lines = []
+    for index, line in read_lines(input_path, checkpoint):
+        indices.append(index)
+        lines.append(line if line.endswith(b'\n') else line + b'\n')
+        if len(lines) >= chunk_size:
+            yield indices, b''.join(lines)
+            indices = array('q')
+            lines = []
+    if lines:
+        yield indices, b''.join(lines)
+
+def build_payload(config, template, row, temperature=0.1, max_tokens=None):
+    # Returns the request payload for one row, or the rendering error, which
+    # complete_many passes through as a failed item without sending anything
+    if isinstance(row, Exception):
+        return row
+    try:
+        rendered = PromptManager.render_split(
+            template, context_window=config.context_window, max_tokens=max_tokens, **row
+        )
+    except ValueError as e:
+        return e
+    return {
+        'model': config.model,
+        'temperature': temperature,
+        'max_tokens': rendered.max_tokens or 1000,
+        'messages': rendered.messages(),
+    }
+
+# Result of the entries iter_deduplicated keeps for rows whose answer is on its way
+PENDING = object()
+
+def encode_record(index, row_id, result):
+    error = None
+    duplicate = None
+    if isinstance(result, Exception):
+        error = str(result)
+        result = None
+    elif isinstance(result, tuple):
+        # A near_duplicates.Match; that module (and numpy) is only imported
+        # by runs with a near-duplicate index
+        duplicate = result
+        result = duplicate.result
+    record = {'index': index, 'id': row_id, 'output': result, 'error': error}
+    if duplicate is not None:
+        record['duplicate_of'] = duplicate.key
+        record['similarity'] = round(duplicate.similarity, 3)
+    return json.dumps(record).encode('utf-8') + b'\n', error
+
+def is_transient(client, result):
+    # A request that still failed after the scheduler's retries (429, 5xx, a
+    # connection error), as opposed to a row that can't be rendered
+    return isinstance(result, Exception) and client.client.scheduler.is_retryable(result)
+
+def duplicate_key(template, row):
+    # (text, scope) a row is compared by in the near-duplicate index: the
+    # template's per-row variables, and the variables shared by its pipeline
+    dynamic = PromptManager.get_metadata(template).get('dynamic_variables')
+    if not dynamic:
+        raise ValueError(f"Template '{template}' declares no dynamic_variables to compare rows by")
+    text = '\n'.join(str(row.get(name, '')) for name in dynamic)
+    shared = PromptManager._entry(template).variables - set(dynamic)
+    scope = {name: row[name] for name in shared if name in row}
+    return text, scope
+
+class ProgressReporter:
+    def __init__(self, interval=2.0, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.rows = 0
+        self.errors = 0
+
+    def update(self, errors=0, rows=1):
+        self.rows += rows
+        self.errors += errors
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        label = "Done" if final else "Progress"
+        print(f"{label}: {self.rows} rows ({self.errors} errors) in {elapsed:.1f}s, {rate:.1f} rows/sec",
+              file=self.stream)
+
+async def iter_results(client, template, rows, temperature=0.1, max_tokens=None, pack=False, duplicates=None):
+    # (index, content or exception) for (index, row) pairs, in completion order.
+    # A row may be an exception (see parse_row); it comes back as is.
+    # With a NearDuplicateIndex, rows it matches come back as a Match instead
+    if duplicates is not None:
+        async for index, result in iter_deduplicated(
+            client, template, rows, duplicates, temperature, max_tokens, pack
+        ):
+            yield index, result
+        return
+
+    if pack:
+        from request_packing import RequestPacker
+        packer = RequestPacker(client, template, temperature=temperature, completion_tokens_per_item=max_tokens)
+        async for index, result in packer.run(rows):
+            yield index, result
+        return
+
+    # Maps submission order back to input rows; entries are removed as results
+    # arrive, so it only ever holds the rows currently in flight
+    in_flight = {}
+
+    def payloads():
+        for sequence, (index, row) in enumerate(rows):
+            in_flight[sequence] = index
+            yield build_payload(client.client.config, template, row, temperature, max_tokens)
+
+    async for sequence, result in client.complete_many(payloads(), template=template):
+        yield in_flight.pop(sequence), result
+
+async def iter_deduplicated(client, template, rows, duplicates, temperature=0.1, max_tokens=None, pack=False,
+                            window=None):
+    # Rows are looked up a window at a time; the misses of a window are sent
+    # together and their answers added to the index before the next window,
+    # so a later duplicate of a row in this window is answered from it.
+    # Within a window, a miss is also looked up among the window's earlier
+    # misses (the `pending` index): a near-duplicate of one of them isn't
+    # sent but waits for that row's answer, like a single-flight follower,
+    # so a burst of recurring tickets costs one request
+    from near_duplicates import Match
+    window = window or client.concurrency * 4
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, window))
+        if not batch:
+            return
+        misses = []
+        keys = {}
+        pending = duplicates.empty()
+        followers = {}
+        for index, row in batch:
+            if isinstance(row, Exception):
+                misses.append((index, row))
+                continue
+            text, scope = duplicate_key(template, row)
+            match = duplicates.lookup(text, scope, template=template, pending=pending)
+            if match is None:
+                misses.append((index, row))
+                keys[index] = (text, scope, row.get('id', index))
+                pending.add(text, PENDING, key=index, scope=scope)
+            elif match.result is PENDING:
+                followers.setdefault(match.key, []).append((index, match.similarity))
+            else:
+                yield index, match
+        async for index, result in iter_results(client, template, misses, temperature, max_tokens, pack):
+            if index not in keys:
+                yield index, result
+                continue
+            text, scope, key = keys.pop(index)
+            if not isinstance(result, Exception):
+                duplicates.add(text, result, key=key, scope=scope)
+            yield index, result
+            for follower, similarity in followers.pop(index, ()):
+                yield follower, result if isinstance(result, Exception) else Match(key, result, similarity)
+
+async def run_batch(config, template, input_path, output_path, concurrency=10, temperature=0.1,
+                    max_tokens=None, checkpoint_every=1.0, pack=False, duplicates=None, duplicates_path=None):
+    # duplicates: a NearDuplicateIndex, saved to duplicates_path when the run
+    # ends, even if it ends with an error
+    checkpoint_path = output_path + '.checkpoint'
+    checkpoint = Checkpoint.load(checkpoint_path)
+    recover_output(output_path, checkpoint)
+    progress = ProgressReporter()
+    row_ids = {}
+
+    def rows():
+        for index, row in read_rows(input_path, checkpoint):
+            row_ids[index] = row_id(row)
+            yield index, row
+
+    try:
+        with open(output_path, 'ab') as output:
+            last_checkpoint = time.perf_counter()
+            async with AsyncCompletionsClient(config, concurrency=concurrency) as client:
+                results = iter_results(client, template, rows(), temperature, max_tokens, pack, duplicates)
+                async for index, result in results:
+                    if is_transient(client, result):
+                        row_ids.pop(index)
+                        checkpoint.mark_failed(index)
+                        progress.update(errors=1)
+                        continue
+                    line, error = encode_record(index, row_ids.pop(index), result)
+                    output.write(line)
+                    checkpoint.mark_done(index)
+                    progress.update(error is not None)
+
+                    now = time.perf_counter()
+                    if now - last_checkpoint >= checkpoint_every:
+                        output.flush()
+                        checkpoint.save(output.tell())
+                        last_checkpoint = now
+            output.flush()
+            checkpoint.save(output.tell())
+    finally:
+        if duplicates is not None and duplicates_path:
+            duplicates.save(duplicates_path)
+    progress.report(final=True)
+    report_failed(checkpoint, progress)
+    if duplicates is not None:
+        stats = duplicates.stats()
+        print(f"Near-duplicates: {stats['hits']}/{stats['lookups']} rows answered from the index "
+              f"({stats['hit_rate']:.1%}), {stats['size']} entries", file=progress.stream)
+    return progress
+
+def report_failed(checkpoint, progress):
+    if checkpoint.failed:
+        print(f"{len(checkpoint.failed)} rows failed after retries and weren't written; "
+              f"run the same command again to retry them", file=progress.stream)
+
+ChunkResult = namedtuple('ChunkResult', ['indices', 'output', 'errors', 'metrics', 'failed'])
+
+class _Worker:
+    def __init__(self, template, concurrency, temperature, max_tokens, pack, metrics):
+        self.config = Config.load()
+        self.template = template
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.pack = pack
+        # Compile the template and read its budget policy before the first chunk
+        PromptManager.get_metadata(template)
+        # Hooks inherited from the parent can't report from here; the worker
+        # aggregates its own metrics and ships them back with each chunk
+        instrumentation.hooks.clear()
+        self.metrics = instrumentation.add_hook(MetricsAggregator()) if metrics else None
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = AsyncCompletionsClient(self.config, concurrency=concurrency)
+
+    async def run(self, indices, blob):
+        # Every line of a chunk ends with b'\n' (read_chunks); splitting on
+        # that alone keeps positions in step with indices
+        rows = [parse_row(line) for line in blob.split(b'\n')[:-1]]
+        results = iter_results(
+            self.client, self.template, enumerate(rows), self.temperature, self.max_tokens, self.pack
+        )
+        output = bytearray()
+        done = array('q')
+        failed = array('q')
+        errors = 0
+        async for position, result in results:
+            if is_transient(self.client, result):
+                failed.append(indices[position])
+                errors += 1
+                continue
+            line, error = encode_record(indices[position], row_id(rows[position]), result)
+            output += line
+            done.append(indices[position])
+            errors += error is not None
+        metrics = self.metrics.snapshot(reset=True) if self.metrics is not None else None
+        return ChunkResult(done, bytes(output), errors, metrics, failed)
+
+    async def serve(self, tasks, results, chunks_at_once=2):
+        # Takes chunks from `tasks` until it gets None, running up to
+        # chunks_at_once of them on the shared client (whose concurrency
+        # bounds the requests of all of them together); each finished
+        # ChunkResult goes to `results`
+        loop = asyncio.get_running_loop()
+        active = set()
+        getter = None
+        stopping = False
+        while active or not stopping:
+            if getter is None and not stopping and len(active) < chunks_at_once:
+                getter = loop.run_in_executor(None, tasks.get)
+            waiting = (active | {getter}) if getter is not None else active
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future is getter:
+                    getter = None
+                    chunk = future.result()
+                    if chunk is None:
+                        stopping = True
+                    else:
+                        active.add(asyncio.ensure_future(self.run(*chunk)))
+                else:
+                    active.discard(future)
+                    results.put(future.result())
+
+def _worker_main(tasks, results, template, concurrency, temperature, max_tokens, pack, metrics):
+    # Entry point of a worker process; an exception is sent to the parent,
+    # which stops the run with it
+    try:
+        worker = _Worker(template, concurrency, temperature, max_tokens, pack, metrics)
+        worker.loop.run_until_complete(worker.serve(tasks, results))
+    except Exception as e:
+        results.put(e)
+
+def _next_result(results, workers):
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            # Workers only exit once told to, so an exited one has crashed
+            for worker in workers:
+                if worker.exitcode is not None:
+                    raise RuntimeError(f"Batch worker process exited with code {worker.exitcode}")
+            continue
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+def _stop_workers(workers, tasks):
+    for _ in workers:
+        tasks.put(None)
+    for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+            worker.terminate()
+
+def run_batch_processes(config, template, input_path, output_path, processes, concurrency=10, temperature=0.1,
+                        max_tokens=None, chunk_size=64, checkpoint_every=1.0, pack=False, metrics=None):
+    # Same input, output and checkpoint format as run_batch. concurrency is
+    # per worker; at most 3 chunks per worker are handed out at once (two
+    # running, one waiting in the queue)
+    checkpoint_path = output_path + '.checkpoint'
+    checkpoint = Checkpoint.load(checkpoint_path)
+    recover_output(output_path, checkpoint)
+    progress = ProgressReporter()
+    chunks = read_chunks(input_path, checkpoint, chunk_size)
+
+    context = multiprocessing.get_context()
+    tasks = context.Queue()
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_worker_main,
+            args=(tasks, results, template, concurrency, temperature, max_tokens, pack, metrics is not None),
+            daemon=True,
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        with open(output_path, 'ab') as output:
+            last_checkpoint = time.perf_counter()
+            outstanding = 0
+            exhausted = False
+            while True:
+                while not exhausted and outstanding < processes * 3:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    tasks.put(chunk)
+                    outstanding += 1
+                if not outstanding:
+                    break
+                result = _next_result(results, workers)
+                outstanding -= 1
+                output.write(result.output)
+                for index in result.indices:
+                    checkpoint.mark_done(index)
+                for index in result.failed:
+                    checkpoint.mark_failed(index)
+                progress.update(result.errors, rows=len(result.indices) + len(result.failed))
+                if result.metrics is not None:
+                    metrics.merge(result.metrics)
+
+                now = time.perf_counter()
+                if now - last_checkpoint >= checkpoint_every:
+                    output.flush()
+                    checkpoint.save(output.tell())
+                    last_checkpoint = now
+            output.flush()
+            checkpoint.save(output.tell())
+    finally:
+        _stop_workers(workers, tasks)
+    progress.report(final=True)
+    report_failed(checkpoint, progress)
+    return progress
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a template for every JSONL row and collect completions")
+    parser.add_argument('template', help="template name, e.g. ticket_analysis")
+    parser.add_argument('input', help="JSONL file, one object of template variables per line")
+    parser.add_argument('output', help="JSONL file results are appended to")
+    parser.add_argument('--concurrency', type=int, default=None, help="requests in flight (default: CODY_POOL_SIZE)")
+    parser.add_argument('--temperature', type=float, default=0.1)
+    parser.add_argument('--max-tokens', type=int, default=None, help="completion budget (default: template policy or 1000)")
+    parser.add_argument('--processes', type=int, default=0, help="worker processes (default: run in this process)")
+    parser.add_argument('--chunk-size', type=int, default=64, help="rows sent to a worker process at a time")
+    parser.add_argument('--pack', action='store_true',
+                        help="answer several rows per request using the template's packing policy "
+                             "(--max-tokens is then per row)")
+    parser.add_argument('--dedup-index', help="near-duplicate index file (.npz); rows matching an earlier answer "
+                                              "reuse it, and the index is saved here for the next run")
+    parser.add_argument('--dedup-threshold', type=float, default=None,
+                        help="Jaccard similarity a row needs to reuse an answer (default: 0.8, or the saved index's)")
+    parser.add_argument('--metrics', help="write latency/token metrics here (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args(argv)
+    if args.dedup_index and args.processes:
+        parser.error("--dedup-index needs one shared index and can't be combined with --processes")
+
+    config = Config.load()
+    config.validate()
+    metrics = instrumentation.add_hook(MetricsAggregator()) if args.metrics else None
+    duplicates = None
+    if args.dedup_index:
+        from near_duplicates import NearDuplicateIndex
+        if os.path.exists(args.dedup_index):
+            duplicates = NearDuplicateIndex.load(args.dedup_index, threshold=args.dedup_threshold)
+        else:
+            duplicates = NearDuplicateIndex(threshold=args.dedup_threshold or 0.8)
+    if args.processes:
+        run_batch_processes(
+            config,
+            args.template,
+            args.input,
+            args.output,
+            args.processes,
+            concurrency=args.concurrency or config.pool_size,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            chunk_size=args.chunk_size,
+            pack=args.pack,
+            metrics=metrics,
+        )
+    else:
+        asyncio.run(run_batch(
+            config,
+            args.template,
+            args.input,
+            args.output,
+            concurrency=args.concurrency or config.pool_size,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            pack=args.pack,
+            duplicates=duplicates,
+            duplicates_path=args.dedup_index,
+        ))
+    if metrics is not None:
+        with open(args.metrics, 'w') as file:
+            file.write(metrics.to_prometheus() if args.metrics.endswith('.prom') else metrics.to_json())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,562 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import requests
+from config import Config, Endpoint
+from batch_runner import duplicate_key, iter_results
+from completions_client import AsyncCompletionsClient, CompletionsClient, CompletionsError
+from endpoint_router import CircuitBreaker, EndpointRouter, NoEndpointAvailable
+from hedging import HedgeCancelled, HedgingPolicy
+from mock_server import start_mock_server
+from near_duplicates import NearDuplicateIndex
+from prompt_manager import PromptManager
+from scheduler import RequestScheduler
+
+# --------------------------------------------------------------
+# Benchmarks for the hot paths, against a local mock endpoint
+# --------------------------------------------------------------
+# Measures template rendering, client throughput and latency, streaming,
+# memory per in-flight request and worker cold start without a live
+# CODY_COMPLETIONS_ENDPOINT.
+#
+#   python benchmark.py                        # run every suite
+#   python benchmark.py render client          # run selected suites
+#   python benchmark.py --json > baseline.json
+#   python benchmark.py --baseline baseline.json --tolerance 0.2
+#
+# With --baseline, any throughput metric that drops (or latency/memory metric
+# that rises) by more than the tolerance is reported and the exit code is 1.
+
+TICKET = {
+    'pipeline': 'helpdesk',
+    'name': 'Support Bot',
+    'company': 'TechGear',
+    'ticket': 'Sender: mark.johnson@techgear.internal\nSubject: Unable to access shared drive\n'
+              'Body: I get a "permission denied" error when I try to open any files.',
+}
+
+# Metrics where a smaller value is better; everything else is a rate
+LOWER_IS_BETTER = ('_ms', '_us', '_kb', 'endpoint_requests_per_burst', '_requests_per_ticket', '_generated_tokens',
+                   '_endpoint_share', '_extra_requests', 'retries_per_request')
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def timed_loop(function, seconds):
+    # Calls function repeatedly for ~seconds; returns calls per second
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        function()
+        calls += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - start)
+
+def mock_config(server):
+    config = Config()
+    config.completions = server.url
+    config.sg_token = 'benchmark-token'
+    config.endpoints = []
+    config.x_requested_with = 'benchmark'
+    config.model = 'mock-model'
+    config.response_cache_path = None
+    # The suites send one payload repeatedly to measure the endpoint path
+    config.single_flight = False
+    return config
+
+def bench_render(args):
+    PromptManager.get_prompt('ticket_analysis', **TICKET)
+    macros = PromptManager.get_macros('prompts')
+    batch = 20000
+    start = time.perf_counter()
+    for _ in PromptManager.render_many('ticket_analysis', itertools.repeat(TICKET, batch)):
+        pass
+    render_many_elapsed = time.perf_counter() - start
+    return {
+        'get_prompt_per_sec': timed_loop(lambda: PromptManager.get_prompt('ticket_analysis', **TICKET), args.seconds),
+        'render_many_per_sec': batch / render_many_elapsed,
+        'render_budgeted_per_sec': timed_loop(
+            lambda: PromptManager.render_budgeted('ticket_analysis', **TICKET), args.seconds
+        ),
+        'render_split_per_sec': timed_loop(lambda: PromptManager.render_split('ticket_analysis', **TICKET), args.seconds),
+        'macro_concept_per_sec': timed_loop(lambda: macros['concept']('SOLID', True), args.seconds),
+        'macro_language_per_sec': timed_loop(lambda: macros['language']('Python', False), args.seconds),
+        'macro_pattern_per_sec': timed_loop(lambda: macros['pattern']('Observer', True), args.seconds),
+        'render_macro_per_sec': timed_loop(
+            lambda: PromptManager.render_macro('prompts', 'concept', topic='SOLID', conciseness=True), args.seconds
+        ),
+    }
+
+def bench_client(args):
+    server = start_mock_server(latency=args.latency)
+    client = CompletionsClient(mock_config(server), scheduler=RequestScheduler(max_retries=0))
+    payload = client.build_payload('What is SOLID principles?')
+    client.post(payload)
+
+    latencies = []
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    while time.perf_counter() < deadline:
+        begin = time.perf_counter()
+        client.post(payload, use_cache=False)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.shutdown()
+    return {
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+def bench_async(args):
+    server = start_mock_server(latency=args.latency)
+    config = mock_config(server)
+
+    async def run():
+        latencies = []
+        async with AsyncCompletionsClient(config, concurrency=args.concurrency) as client:
+            payload = client.build_payload('What is SOLID principles?')
+
+            # `concurrency` workers each issue requests back to back, so the
+            # latencies measure the endpoint round trip rather than queueing
+            async def worker(count):
+                for _ in range(count):
+                    begin = time.perf_counter()
+                    await client.post(payload)
+                    latencies.append(time.perf_counter() - begin)
+
+            await asyncio.gather(*(worker(1) for _ in range(args.concurrency)))
+            latencies.clear()
+            per_worker = max(1, args.requests // args.concurrency)
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(per_worker) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+        return latencies, elapsed
+
+    latencies, elapsed = asyncio.run(run())
+    server.shutdown()
+    return {
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+def bench_errors(args):
+    # Throughput of successful requests while the endpoint rejects a share
+    # of them with 429/503 and the scheduler retries
+    server = start_mock_server(latency=args.latency, error_rate=args.error_rate, retry_after='0', seed=0)
+    config = mock_config(server)
+    client = CompletionsClient(config, scheduler=RequestScheduler(max_retries=10, backoff_base=0.001))
+    payload = client.build_payload('What is SOLID principles?')
+    latencies = []
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    while time.perf_counter() < deadline:
+        begin = time.perf_counter()
+        client.post(payload, use_cache=False)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.shutdown()
+    return {
+        'requests_per_sec': len(latencies) / elapsed,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'retries_per_request': client.scheduler.retries / max(1, len(latencies)),
+    }
+
+def bench_single_flight(args):
+    # A burst of identical deterministic requests, as when many workers ask
+    # the same FAQ-style prompt: endpoint requests sent and burst latency
+    server = start_mock_server(latency=max(args.latency, 0.05))
+    config = mock_config(server)
+    config.single_flight = True
+
+    async def run():
+        bursts = []
+        async with AsyncCompletionsClient(config, concurrency=args.concurrency) as client:
+            for burst in range(args.stream_runs):
+                payload = client.build_payload(f'What is the Observer pattern? ({burst})')
+                begin = time.perf_counter()
+                await asyncio.gather(*(client.post(payload) for _ in range(args.concurrency * 4)))
+                bursts.append(time.perf_counter() - begin)
+        return bursts
+
+    bursts = asyncio.run(run())
+    server.shutdown()
+    return {
+        'burst_p50_ms': percentile(bursts, 0.50) * 1000,
+        'endpoint_requests_per_burst': server.settings.requests / len(bursts),
+        'callers_per_burst': args.concurrency * 4,
+    }
+
+def bench_packing(args):
+    # A backlog of short tickets sent one per request and packed several to a
+    # request (request_packing.py): requests per ticket and backlog time
+    server = start_mock_server(latency=max(args.latency, 0.05))
+    config = mock_config(server)
+    rows = [
+        (index, dict(TICKET, ticket=f"Sender: user{index}@techgear.internal\nSubject: Printer {index} offline\n"
+                                    f"Body: The printer on floor {index % 7} shows an error."))
+        for index in range(args.requests // 4)
+    ]
+
+    async def run(pack):
+        async with AsyncCompletionsClient(config, concurrency=args.concurrency) as client:
+            start = time.perf_counter()
+            async for _ in iter_results(client, 'ticket_analysis', rows, pack=pack):
+                pass
+            return time.perf_counter() - start
+
+    results = {}
+    for label, pack in (('single', False), ('packed', True)):
+        before = server.settings.requests
+        elapsed = asyncio.run(run(pack))
+        results[f'{label}_backlog_ms'] = elapsed * 1000
+        results[f'{label}_requests_per_ticket'] = (server.settings.requests - before) / len(rows)
+    server.shutdown()
+    return results
+
+# Recurring ticket bodies; the backlog varies only their senders and numbers
+RECURRING_TICKETS = (
+    'I was charged twice for order {n} this month. Please refund the duplicate charge on my card.',
+    'I get "permission denied" when I open the shared drive folder Projects-{n}. Please restore my access.',
+    'My headphones (serial {n}) stopped charging after the firmware update. The LED blinks red.',
+    'The printer on floor {n} shows a paper jam error, but there is no paper stuck inside.',
+)
+
+def bench_duplicates(args):
+    # A backlog of recurring tickets sent as-is and through a near-duplicate
+    # index (near_duplicates.py): requests per ticket, backlog time and the
+    # cost of one index lookup
+    server = start_mock_server(latency=max(args.latency, 0.05))
+    config = mock_config(server)
+    rows = [
+        (index, dict(TICKET, ticket=f"Sender: user{index}@techgear.internal\nSubject: Ticket {index}\n"
+                                    f"Body: {RECURRING_TICKETS[index % len(RECURRING_TICKETS)].format(n=index)}"))
+        for index in range(args.requests // 4)
+    ]
+
+    async def run(duplicates):
+        async with AsyncCompletionsClient(config, concurrency=args.concurrency) as client:
+            start = time.perf_counter()
+            async for _ in iter_results(client, 'ticket_analysis', rows, duplicates=duplicates):
+                pass
+            return time.perf_counter() - start
+
+    results = {}
+    duplicates = NearDuplicateIndex()
+    for label, index in (('direct', None), ('deduplicated', duplicates)):
+        before = server.settings.requests
+        elapsed = asyncio.run(run(index))
+        results[f'{label}_backlog_ms'] = elapsed * 1000
+        results[f'{label}_requests_per_ticket'] = (server.settings.requests - before) / len(rows)
+    server.shutdown()
+    results['hit_rate'] = duplicates.stats()['hit_rate']
+    keys = itertools.cycle([duplicate_key('ticket_analysis', row) for _, row in rows])
+    results['lookups_per_sec'] = timed_loop(lambda: duplicates.query(*next(keys)), args.seconds)
+    return results
+
+def breaker_recovers(error):
+    # An ejected endpoint whose half-open trial ends with `error` has to leave
+    # the half-open state, whatever the error was. The second endpoint keeps
+    # the first one ejectable and is parked so the trial goes to the first
+    now = [0.0]
+    router = EndpointRouter(
+        [Endpoint(f'http://127.0.0.1:{port}', 'benchmark-token', None, None) for port in (1, 2)],
+        failure_threshold=1, cooldown=1.0, clock=lambda: now[0],
+    )
+    ejected, standby = router.endpoints
+    router.acquire({})
+    router.release(ejected, 1.0, requests.ConnectionError())
+    router.acquire({})
+    router.release(standby, 1.0, CompletionsError('injected', status_code=429, retry_after='100'))
+    now[0] = 2.0
+    endpoint, _ = router.acquire({})
+    router.release(endpoint, 1.0, error)
+    return endpoint is ejected and ejected.breaker.state != CircuitBreaker.HALF_OPEN
+
+def last_endpoint_survives():
+    # A burst of 5xx on the only endpoint must not eject it
+    router = EndpointRouter([Endpoint('http://127.0.0.1:1', 'benchmark-token', None, None)], failure_threshold=5)
+    for _ in range(20):
+        endpoint, _ = router.acquire({})
+        router.release(endpoint, 1.0, CompletionsError('injected', status_code=503))
+    try:
+        router.release(router.acquire({})[0])
+    except NoEndpointAvailable:
+        return False
+    return True
+
+def bench_routing(args):
+    # Requests spread over two healthy endpoints, a slow one and one that
+    # always fails (endpoint_router.py): throughput, tail latency and the
+    # share of requests the slow and failing endpoints still get
+    servers = [
+        start_mock_server(latency=args.latency),
+        start_mock_server(latency=args.latency),
+        start_mock_server(latency=max(args.latency * 20, 0.25)),
+        start_mock_server(error_rate=1.0, error_statuses=(503,)),
+    ]
+    config = mock_config(servers[0])
+    config.endpoints = [Endpoint(server.url, 'benchmark-token', None, None) for server in servers]
+    config.breaker_cooldown = 60.0
+    results = {}
+    for policy in ('ewma', 'least_outstanding'):
+        config.routing = policy
+        before = [server.settings.requests for server in servers]
+        client = CompletionsClient(config, scheduler=RequestScheduler(max_retries=10, backoff_base=0.001))
+
+        async def run():
+            latencies = []
+            async with AsyncCompletionsClient(config, concurrency=args.concurrency, client=client) as async_client:
+                payload = async_client.build_payload('What is SOLID principles?')
+
+                async def worker(count):
+                    for _ in range(count):
+                        begin = time.perf_counter()
+                        await async_client.post(payload)
+                        latencies.append(time.perf_counter() - begin)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(worker(args.requests // 4 // args.concurrency) for _ in range(args.concurrency)))
+                return latencies, time.perf_counter() - start
+
+        latencies, elapsed = asyncio.run(run())
+        sent = [server.settings.requests - count for server, count in zip(servers, before)]
+        results[f'{policy}_requests_per_sec'] = len(latencies) / elapsed
+        results[f'{policy}_p99_ms'] = percentile(latencies, 0.99) * 1000
+        results[f'{policy}_slow_endpoint_share'] = sent[2] / sum(sent)
+        results[f'{policy}_failing_endpoint_share'] = sent[3] / sum(sent)
+    for server in servers:
+        server.shutdown()
+    trial_errors = [
+        None,
+        HedgeCancelled(),
+        requests.exceptions.ChunkedEncodingError(),
+        ValueError('invalid JSON body'),
+        CompletionsError('injected', status_code=429),
+        CompletionsError('injected', status_code=503),
+    ]
+    results['breaker_recovery_rate'] = sum(map(breaker_recovers, trial_errors)) / len(trial_errors)
+    results['last_endpoint_available'] = float(last_endpoint_survives())
+    return results
+
+def bench_hedging(args):
+    # Sequential interactive requests against an endpoint where 2% of the
+    # requests stall (hedging.py): tail latency with and without hedging, and
+    # what the hedges cost in extra requests. The stalls have to be rarer
+    # than 1 - percentile, or the hedge delay lands in the stall itself
+    server = start_mock_server(latency=args.latency, tail_rate=0.02, tail_latency=max(args.latency * 50, 0.25))
+    results = {}
+    for name, hedging in (('plain', False), ('hedged', HedgingPolicy())):
+        client = CompletionsClient(mock_config(server), scheduler=RequestScheduler(max_retries=0), hedging=hedging)
+        payload = client.build_payload('What is SOLID principles?')
+        # Enough requests for the hedge delay to be based on samples
+        for _ in range(20):
+            client.post(payload, use_cache=False)
+        before = server.settings.requests
+        latencies = []
+        for _ in range(args.requests // 5):
+            begin = time.perf_counter()
+            client.post(payload, use_cache=False)
+            latencies.append(time.perf_counter() - begin)
+        results[f'{name}_p50_ms'] = percentile(latencies, 0.50) * 1000
+        results[f'{name}_p99_ms'] = percentile(latencies, 0.99) * 1000
+        if hedging:
+            stats = hedging.stats()
+            results['hedged_extra_requests'] = (server.settings.requests - before) / len(latencies) - 1
+            results['hedge_win_rate'] = stats['hedge_wins'] / max(1, stats['hedges'])
+        client.close()
+    server.shutdown()
+    return results
+
+def bench_stream(args):
+    server = start_mock_server(latency=args.latency, chunk_delay=args.chunk_delay)
+    client = CompletionsClient(mock_config(server))
+    payload = client.build_payload('Explain streaming.')
+    ttfts, rates = [], []
+    for _ in range(args.stream_runs):
+        _, stats = client.stream(payload)
+        ttfts.append(stats.time_to_first_token)
+        rates.append(stats.tokens_per_second)
+    client.close()
+    server.shutdown()
+    return {
+        'ttft_p50_ms': percentile(ttfts, 0.50) * 1000,
+        'tokens_per_sec': statistics.median(rates),
+    }
+
+def bench_structured(args):
+    # Structured ticket analyses streamed to the end and closed once intent
+    # and confidence are in: time to the routing fields, total time and
+    # completion tokens the endpoint actually generated per answer
+    server = start_mock_server(latency=args.latency, chunk_delay=args.chunk_delay)
+    client = CompletionsClient(mock_config(server))
+    schema = PromptManager.get_metadata('ticket_analysis')['output_schema']
+    rendered = PromptManager.render_split('ticket_analysis', structured=True, **TICKET)
+    payload = {'model': 'mock', 'temperature': 0.1, 'max_tokens': 1000, 'messages': rendered.messages()}
+    results = {}
+    for label, stop in (('full', False), ('early', True)):
+        routed, totals = [], []
+        before = server.settings.streamed_tokens
+        for _ in range(args.stream_runs):
+            start = time.perf_counter()
+            ready = []
+
+            def on_field(name, value):
+                if name == 'confidence':
+                    ready.append(time.perf_counter() - start)
+
+            result = client.stream_structured(payload, schema, on_field=on_field, stop_when_required=stop)
+            totals.append(result.stats.total_time)
+            routed.append(ready[0])
+        # Let the server notice hung-up streams before counting what it sent
+        time.sleep(0.05)
+        results[f'{label}_routing_fields_p50_ms'] = percentile(routed, 0.50) * 1000
+        results[f'{label}_total_p50_ms'] = percentile(totals, 0.50) * 1000
+        results[f'{label}_generated_tokens'] = (server.settings.streamed_tokens - before) / args.stream_runs
+    client.close()
+    server.shutdown()
+    return results
+
+def bench_memory(args):
+    # Peak Python heap while `concurrency` requests are held open by a slow
+    # endpoint, divided by the number of requests in flight
+    server = start_mock_server(latency=max(args.latency, 0.2))
+    config = mock_config(server)
+
+    async def run():
+        async with AsyncCompletionsClient(config, concurrency=args.concurrency) as client:
+            payload = client.build_payload('What is SOLID principles?')
+            await client.post(payload)
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            await asyncio.gather(*(client.post(payload) for _ in range(args.concurrency)))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return (peak - baseline) / args.concurrency
+
+    per_request = asyncio.run(run())
+    server.shutdown()
+    return {'memory_per_in_flight_kb': per_request / 1024}
+
+# What a short-lived batch worker does before its first request
+WORKER_STARTUP = (
+    "from config import Config\n"
+    "from completions_client import AsyncCompletionsClient\n"
+    "from prompt_manager import PromptManager\n"
+    "Config.load()\n"
+    "PromptManager.render_budgeted('ticket_analysis', ticket='Printer offline', pipeline='helpdesk')\n"
+)
+# A --processes worker also imports the batch runner, which must stay as light
+BATCH_WORKER_STARTUP = "import batch_runner\n" + WORKER_STARTUP
+
+def bench_startup(args):
+    # Wall time of fresh interpreters importing the client and rendering one
+    # prompt, with the Jinja bytecode cache warm and with it disabled
+    cache_dir = tempfile.mkdtemp(prefix='cody-bytecode-')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def cold_start(code, bytecode_cache):
+        env = dict(os.environ, CODY_BYTECODE_CACHE=bytecode_cache)
+        times = []
+        for _ in range(args.startup_runs):
+            begin = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True)
+            times.append(time.perf_counter() - begin)
+        return statistics.median(times) * 1000
+
+    cold_start(WORKER_STARTUP, cache_dir)
+    return {
+        'interpreter_ms': cold_start('pass', ''),
+        'cold_start_ms': cold_start(WORKER_STARTUP, cache_dir),
+        'cold_start_no_bytecode_cache_ms': cold_start(WORKER_STARTUP, ''),
+        'batch_worker_cold_start_ms': cold_start(BATCH_WORKER_STARTUP, cache_dir),
+    }
+
+SUITES = {
+    'render': bench_render,
+    'client': bench_client,
+    'async': bench_async,
+    'errors': bench_errors,
+    'single_flight': bench_single_flight,
+    'packing': bench_packing,
+    'duplicates': bench_duplicates,
+    'routing': bench_routing,
+    'hedging': bench_hedging,
+    'stream': bench_stream,
+    'structured': bench_structured,
+    'memory': bench_memory,
+    'startup': bench_startup,
+}
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for suite, metrics in results.items():
+        for name, value in metrics.items():
+            previous = baseline.get(suite, {}).get(name)
+            if not previous:
+                continue
+            change = (value - previous) / previous
+            if name.endswith(LOWER_IS_BETTER) or name.startswith('ttft'):
+                regressed = change > tolerance
+            else:
+                regressed = -change > tolerance
+            if regressed:
+                regressions.append(f"{suite}.{name}: {previous:.2f} -> {value:.2f} ({change:+.0%})")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark rendering and the completions client against a mock endpoint")
+    parser.add_argument('suites', nargs='*', help=f"suites to run: {', '.join(SUITES)} (default: all)")
+    parser.add_argument('--seconds', type=float, default=2.0, help="duration of timed loops")
+    parser.add_argument('--latency', type=float, default=0.005, help="mock endpoint latency in seconds")
+    parser.add_argument('--chunk-delay', type=float, default=0.002, help="delay between streamed chunks")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000, help="requests in the async suite")
+    parser.add_argument('--stream-runs', type=int, default=20)
+    parser.add_argument('--startup-runs', type=int, default=10, help="fresh interpreters per startup measurement")
+    parser.add_argument('--error-rate', type=float, default=0.2)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suite(s): {', '.join(sorted(unknown))}")
+
+    results = {}
+    for suite in args.suites or SUITES:
+        results[suite] = SUITES[suite](args)
+        if not args.json:
+            print(f"\n{suite}")
+            for name, value in results[suite].items():
+                print(f"  {name:<28} {value:>12.2f}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
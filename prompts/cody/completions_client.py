@@ -0,0 +1,517 @@
+import asyncio
+import contextlib
+import functools
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from endpoint_router import EndpointRouter, NoEndpointAvailable
+from hedging import HedgeCancelled, HedgingPolicy
+from instrumentation import instrumentation
+from scheduler import RequestScheduler
+from single_flight import AsyncSingleFlight, SingleFlight
+from structured_output import IncrementalJSONParser, validate_fields
+from token_budget import PromptBudgetError, fit_payload
+
+# Timing of a streamed completion; tokens counts content deltas, which is one
+# token per chunk for the chat-completions streaming format
+StreamStats = namedtuple(
+    'StreamStats',
+    ['time_to_first_token', 'total_time', 'tokens', 'tokens_per_second'],
+)
+
+# Outcome of stream_structured: the parsed top-level fields, the raw text
+# received, and whether the stream was closed once the required fields were in
+StructuredStream = namedtuple('StructuredStream', ['fields', 'content', 'cancelled', 'stats'])
+
+def iter_stream_lines(chunks):
+    # Splits the raw stream on b'\n' alone and decodes each line. Decoding
+    # first and splitting with str.splitlines() would also break lines at
+    # U+2028, U+2029 and U+0085, which JSON allows unescaped inside strings
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield _decode_line(line)
+    if pending:
+        yield _decode_line(pending)
+
+def _decode_line(line):
+    try:
+        return line.rstrip(b'\r').decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise CompletionsError(f"Undecodable line in completion stream: {e}") from e
+
+def iter_sse_data(lines):
+    # Server-sent events: "data:" lines accumulate until a blank line ends the event
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield '\n'.join(data)
+                data = []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        if field == 'data':
+            data.append(value[1:] if value.startswith(' ') else value)
+    if data:
+        yield '\n'.join(data)
+
+def iter_content_deltas(lines):
+    for data in iter_sse_data(lines):
+        if data == '[DONE]':
+            return
+        try:
+            event = json.loads(data)
+        except ValueError as e:
+            raise CompletionsError(f"Invalid event in completion stream: {data[:200]!r}") from e
+        for choice in event.get('choices', []):
+            delta = choice.get('delta') or choice.get('message') or {}
+            content = delta.get('content')
+            if content:
+                yield content
+
+class CompletionsError(Exception):
+    def __init__(self, message, status_code=None, text=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(
+            f"Error: {response.status_code}\n{response.text}",
+            status_code=response.status_code,
+            text=response.text,
+            retry_after=response.headers.get('Retry-After'),
+        )
+
+class CompletionsClient:
+    # One pooled session per client: connections to the completions endpoint
+    # are kept alive and reused instead of paying a TCP+TLS handshake per call
+    def __init__(self, config, pool_size=None, keep_alive=None, timeout=None, cache=None,
+                 scheduler=None, single_flight=None, router=None, hedging=None):
+        # hedging: a HedgingPolicy, True for one built from the config, False
+        # for none; by default CODY_HEDGING decides
+        self.config = config
+        # Picks the endpoint of every attempt, so a retry can fail over to
+        # another region; with one endpoint it always picks that one
+        self.router = router or EndpointRouter.from_config(config)
+        self.scheduler = scheduler or RequestScheduler(
+            requests_per_minute=config.requests_per_minute,
+            tokens_per_minute=config.tokens_per_minute,
+            max_retries=config.max_retries,
+        )
+        if cache is None and config.response_cache_path:
+            # sqlite3 is only imported by processes that use the cache
+            from response_cache import ResponseCache
+            cache = ResponseCache(config.response_cache_path, ttl=config.response_cache_ttl)
+        self.cache = cache
+        if single_flight is None and config.single_flight:
+            single_flight = SingleFlight()
+        self.single_flight = single_flight
+        pool_size = pool_size or config.pool_size
+        if hedging is None:
+            hedging = config.hedging
+        if hedging is True:
+            hedging = HedgingPolicy.from_config(config, max_workers=2 * pool_size)
+        self.hedging = hedging or None
+        keep_alive = config.keep_alive if keep_alive is None else keep_alive
+        self.timeout = timeout or (config.connect_timeout, config.read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': config.sg_token,
+            'X-Requested-With': config.x_requested_with,
+            'Content-Type': 'application/json',
+        })
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+        if self.hedging is not None:
+            self.hedging.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def build_payload(self, messages, temperature=0.1, max_tokens=1000):
+        if isinstance(messages, str):
+            messages = [{'role': 'user', 'content': messages}]
+        return {
+            'model': self.config.model,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+            'messages': messages,
+        }
+
+    def fit(self, payload):
+        # Local size check: max_tokens is shrunk to what the context window
+        # leaves, and prompts that can't fit fail before any network I/O
+        if not self.config.context_window:
+            return payload
+        try:
+            return fit_payload(payload, self.config.context_window)
+        except PromptBudgetError as e:
+            raise CompletionsError(str(e)) from e
+
+    def post(self, payload, use_cache=True, template=None):
+        # template only labels instrumentation events
+        start = time.perf_counter()
+        payload = self.fit(payload)
+        use_cache = use_cache and self.cache is not None and self.cache.cacheable(payload)
+        if use_cache:
+            response_data = self.cache.get(payload)
+            if response_data is not None:
+                if instrumentation.enabled:
+                    self._emit_request(template, start, {}, response_data, 200, cache_hit=True)
+                return response_data
+
+        timings = {}
+        send = lambda: self.scheduler.call(lambda payload: self._send(payload, timings), payload)
+        shared = False
+        try:
+            if self.single_flight is None:
+                response_data = send()
+            else:
+                response_data, shared = self.single_flight.do(payload, send)
+        except CompletionsError as e:
+            if instrumentation.enabled:
+                self._emit_request(template, start, timings, {}, e.status_code)
+            raise
+        if use_cache and not shared:
+            self.cache.set(payload, response_data)
+        if instrumentation.enabled:
+            self._emit_request(template, start, timings, response_data, 200, shared=shared)
+        return response_data
+
+    def _emit_request(self, template, start, timings, response_data, status, cache_hit=False, shared=False):
+        usage = response_data.get('usage') or {}
+        instrumentation.emit(
+            'request',
+            template=template,
+            endpoint=timings.get('endpoint'),
+            serialize_ms=timings.get('serialize_ms'),
+            ttfb_ms=timings.get('ttfb_ms'),
+            total_ms=(time.perf_counter() - start) * 1000,
+            status=status,
+            prompt_tokens=usage.get('prompt_tokens'),
+            completion_tokens=usage.get('completion_tokens'),
+            cache_hit=cache_hit,
+            shared=shared,
+            hedged=timings.get('hedged'),
+            hedge_won=timings.get('hedge_won'),
+            hedge_delay_ms=timings.get('hedge_delay_ms'),
+        )
+
+    def _acquire_endpoint(self, payload):
+        try:
+            endpoint, wait = self.router.acquire(payload)
+        except NoEndpointAvailable as e:
+            raise CompletionsError(str(e), status_code=503, retry_after=e.retry_after) from e
+        if wait:
+            # The endpoint's own quota; the scheduler already applied the global one
+            self.scheduler.sleep(wait)
+        return endpoint
+
+    def _send(self, payload, timings=None):
+        serialize_start = time.perf_counter()
+        data = json.dumps(payload).encode('utf-8')
+        serialize_end = time.perf_counter()
+        timings = {} if timings is None else timings
+        timings['serialize_ms'] = (serialize_end - serialize_start) * 1000
+        if self.hedging is None:
+            return self._attempt(payload, data, timings)
+
+        def attempt(signals):
+            # Each attempt keeps its own timings; the winner's are reported
+            attempt_timings = {}
+            return self._attempt(payload, data, attempt_timings, signals), attempt_timings
+
+        (response_data, attempt_timings), hedge = self.hedging.run(attempt, admit=self._admit_hedge(payload))
+        timings.update(attempt_timings)
+        timings.update(hedge)
+        return response_data
+
+    def _admit_hedge(self, payload):
+        # The scheduler reserved the global rate limits for one request; a
+        # hedge is another one, sent only if the limits allow it right now
+        return lambda: self.scheduler.try_acquire(payload)
+
+    def _attempt(self, payload, data, timings, signals=None):
+        # One request to one endpoint. Under hedging, signals.first_byte is
+        # set when the headers arrive, and the body is only read if the
+        # attempt hasn't been cancelled by then
+        endpoint = self._acquire_endpoint(payload)
+        if signals is not None:
+            # The hedge delay starts now, after any wait for the endpoint's quota
+            signals.started.set()
+        start = time.perf_counter()
+        error = None
+        try:
+            response = self.session.post(
+                endpoint.url, data=data, timeout=self.timeout, headers=endpoint.headers,
+                stream=signals is not None,
+            )
+            # requests measures elapsed up to the parsed response headers
+            ttfb = response.elapsed.total_seconds()
+            if signals is not None:
+                self._first_byte(response, ttfb, signals)
+            timings['endpoint'] = endpoint.url
+            timings['ttfb_ms'] = ttfb * 1000
+            if response.status_code != 200:
+                raise CompletionsError.from_response(response)
+            return response.json()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.router.release(endpoint, (time.perf_counter() - start) * 1000, error)
+
+    def _first_byte(self, response, ttfb, signals):
+        signals.first_byte.set()
+        self.hedging.observe(ttfb)
+        if signals.cancelled.is_set():
+            # The other attempt already won: hang up instead of reading the body
+            response.close()
+            raise HedgeCancelled()
+
+    def _open_stream(self, payload):
+        if self.hedging is None:
+            return self._open_attempt(payload)
+        response, _ = self.hedging.run(
+            lambda signals: self._open_attempt(payload, signals),
+            discard=lambda response: response.close(),
+            admit=self._admit_hedge(payload),
+        )
+        return response
+
+    def _open_attempt(self, payload, signals=None):
+        # The endpoint is released once the response headers arrive, so its
+        # latency sample is the time to first byte
+        endpoint = self._acquire_endpoint(payload)
+        if signals is not None:
+            signals.started.set()
+        start = time.perf_counter()
+        error = None
+        try:
+            response = self.session.post(
+                endpoint.url, json=payload, timeout=self.timeout, stream=True, headers=endpoint.headers
+            )
+            if signals is not None:
+                self._first_byte(response, response.elapsed.total_seconds(), signals)
+            if response.status_code != 200:
+                error = CompletionsError.from_response(response)
+                response.close()
+                raise error
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.router.release(endpoint, (time.perf_counter() - start) * 1000, error)
+
+    @staticmethod
+    def extract_content(response_data):
+        if 'choices' in response_data and len(response_data['choices']) > 0:
+            message = response_data['choices'][0].get('message', {})
+            return message.get('content', '')
+        raise CompletionsError("No message content found in the response")
+
+    def complete(self, messages, temperature=0.1, max_tokens=1000, template=None):
+        payload = self.build_payload(messages, temperature=temperature, max_tokens=max_tokens)
+        return self.extract_content(self.post(payload, template=template))
+
+    def iter_stream(self, payload):
+        payload = dict(self.fit(payload), stream=True)
+        # Rate limits and retries apply until the stream is open; once deltas
+        # have been yielded a failure can't be retried transparently
+        with self.scheduler.call(self._open_stream, payload) as response:
+            # chunk_size=None hands lines over as soon as they arrive on the socket
+            lines = iter_stream_lines(response.iter_content(chunk_size=None))
+            yield from iter_content_deltas(lines)
+            # Drain the terminating chunk so the connection goes back to the pool
+            for _ in lines:
+                pass
+
+    def stream(self, payload, out=None, template=None):
+        # Writes deltas to `out` as they arrive; returns (content, StreamStats)
+        start = time.perf_counter()
+        first_token = None
+        parts = []
+        for delta in self.iter_stream(payload):
+            if first_token is None:
+                first_token = time.perf_counter()
+            parts.append(delta)
+            if out is not None:
+                out.write(delta)
+                out.flush()
+        stats = self._stream_stats(template, start, first_token, len(parts))
+        return ''.join(parts), stats
+
+    @staticmethod
+    def _stream_stats(template, start, first_token, tokens, **fields):
+        end = time.perf_counter()
+        ttft = (first_token or end) - start
+        generation_time = end - (first_token or end)
+        stats = StreamStats(
+            time_to_first_token=ttft,
+            total_time=end - start,
+            tokens=tokens,
+            tokens_per_second=tokens / generation_time if generation_time > 0 else 0.0,
+        )
+        if instrumentation.enabled:
+            instrumentation.emit(
+                'stream',
+                template=template,
+                ttft_ms=ttft * 1000,
+                total_ms=(end - start) * 1000,
+                completion_tokens=tokens,
+                **fields
+            )
+        return stats
+
+    def stream_structured(self, payload, schema, on_field=None, stop_when_required=True, template=None):
+        # Streams a JSON answer (see structured_output.py) and parses it as it
+        # arrives. on_field(name, value) is called for each top-level field the
+        # moment it is complete. With stop_when_required, the stream is closed
+        # as soon as every required field is in: the connection is dropped
+        # rather than drained, so the endpoint stops generating. Raises
+        # StructuredOutputError if the answer isn't valid or lacks a required field
+        start = time.perf_counter()
+        first_token = None
+        parts = []
+        parser = IncrementalJSONParser()
+        required = schema.get('required', ())
+        cancelled = False
+        deltas = self.iter_stream(payload)
+        try:
+            for delta in deltas:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                parts.append(delta)
+                for name, value in parser.feed(delta):
+                    if on_field is not None:
+                        on_field(name, value)
+                if stop_when_required and not parser.done and required and all(
+                    name in parser.fields for name in required
+                ):
+                    cancelled = True
+                    break
+        finally:
+            deltas.close()
+        stats = self._stream_stats(template, start, first_token, len(parts), cancelled=cancelled)
+        validate_fields(schema, parser.fields)
+        return StructuredStream(parser.fields, ''.join(parts), cancelled, stats)
+
+class AsyncCompletionsClient:
+    # Fans requests out over a thread pool that shares one pooled session.
+    # A global semaphore bounds total in-flight requests and a per-host
+    # semaphore keeps any single endpoint under its own concurrency limit.
+    def __init__(self, config, concurrency=None, per_host_limit=None, client=None):
+        self.concurrency = concurrency or config.pool_size
+        self.per_host_limit = per_host_limit or self.concurrency
+        self.client = client or CompletionsClient(config, pool_size=self.concurrency)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._host_semaphores = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.single_flight = AsyncSingleFlight() if config.single_flight else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+    def build_payload(self, messages, temperature=0.1, max_tokens=1000):
+        return self.client.build_payload(messages, temperature=temperature, max_tokens=max_tokens)
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_semaphores[host]
+
+    async def post(self, payload, template=None):
+        # Identical deterministic payloads already in flight on this loop are
+        # awaited rather than queued for a slot of their own
+        if self.single_flight is None:
+            return await self._post(payload, template)
+        start = time.perf_counter()
+        response_data, shared = await self.single_flight.do(payload, lambda: self._post(payload, template))
+        if shared and instrumentation.enabled:
+            self.client._emit_request(template, start, {}, response_data, 200, shared=True)
+        return response_data
+
+    async def _post(self, payload, template):
+        # With several endpoints, keeping each one's share of the load in
+        # check is the router's job: it routes by requests outstanding per endpoint
+        if len(self.client.router.endpoints) > 1:
+            host_semaphore = contextlib.nullcontext()
+        else:
+            host_semaphore = self._host_semaphore(self.client.config.completions)
+        async with self._semaphore, host_semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(self.client.post, payload, template=template)
+            )
+
+    async def complete(self, messages, temperature=0.1, max_tokens=1000, template=None):
+        payload = self.build_payload(messages, temperature=temperature, max_tokens=max_tokens)
+        return await self.complete_payload(payload, template=template)
+
+    async def complete_payload(self, payload, template=None):
+        return self.client.extract_content(await self.post(payload, template=template))
+
+    async def _complete_payload(self, index, payload, template):
+        if isinstance(payload, Exception):
+            return index, payload
+        try:
+            return index, await self.complete_payload(payload, template=template)
+        except (CompletionsError, requests.RequestException) as e:
+            return index, e
+
+    async def complete_many(self, payloads, template=None):
+        # Yields (index, content) in completion order; failed requests yield
+        # the exception instead of content so one error doesn't stop the batch.
+        # An exception given in place of a payload is passed through unsent.
+        # At most 2x concurrency tasks exist at once, so payloads can be a lazy
+        # iterator over an arbitrarily large backlog.
+        pending = set()
+        payloads = enumerate(payloads)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.concurrency * 2:
+                try:
+                    index, payload = next(payloads)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(self._complete_payload(index, payload, template)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
@@ -1,16 +1,105 @@
-from dotenv import load_dotenv
 import os
+import threading
+from collections import namedtuple
+
+# One completions endpoint with its own credentials and quotas (None = unlimited)
+Endpoint = namedtuple('Endpoint', ['url', 'token', 'requests_per_minute', 'tokens_per_minute'])
+
+def split_list(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+def per_endpoint(value, count, cast=float):
+    # A comma-separated list with one value per endpoint, or a single value for all
+    values = [cast(item) or None for item in split_list(value)]
+    if len(values) == 1:
+        return values * count
+    return values + [None] * (count - len(values))
+
+_dotenv_lock = threading.Lock()
+_dotenv_loaded = False
+
+def load_env():
+    # Reads .env into the environment once per process; later Config()
+    # constructions only read os.environ
+    global _dotenv_loaded
+    with _dotenv_lock:
+        if not _dotenv_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _dotenv_loaded = True
 
 class Config:
+    _shared = None
+
     def __init__(self):
-        load_dotenv()
+        load_env()
         self.completions = os.getenv('CODY_COMPLETIONS_ENDPOINT')
         self.sg_token = os.getenv('ACCESS_TOKEN')
         self.model = os.getenv('model')
         self.x_requested_with = os.getenv('X-Requested-With')
+        # HTTP connection pool used by CompletionsClient
+        self.pool_size = int(os.getenv('CODY_POOL_SIZE', '10'))
+        self.keep_alive = os.getenv('CODY_KEEP_ALIVE', 'true').lower() != 'false'
+        self.connect_timeout = float(os.getenv('CODY_CONNECT_TIMEOUT', '10'))
+        self.read_timeout = float(os.getenv('CODY_READ_TIMEOUT', '120'))
+        # Context window of the model; prompts are measured against it before sending
+        self.context_window = int(os.getenv('CODY_CONTEXT_WINDOW', '0')) or None
+        # Client-side rate limits (unset = unlimited) and retry policy
+        self.requests_per_minute = float(os.getenv('CODY_REQUESTS_PER_MINUTE', '0')) or None
+        self.tokens_per_minute = float(os.getenv('CODY_TOKENS_PER_MINUTE', '0')) or None
+        self.max_retries = int(os.getenv('CODY_MAX_RETRIES', '3'))
+        # On-disk cache for deterministic completions; disabled when unset
+        self.response_cache_path = os.getenv('CODY_RESPONSE_CACHE')
+        self.response_cache_ttl = float(os.getenv('CODY_RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+        # Share one request between concurrent callers sending the same deterministic payload
+        self.single_flight = os.getenv('CODY_SINGLE_FLIGHT', 'true').lower() != 'false'
+        # Several endpoints (comma-separated, with ACCESS_TOKENS in the same
+        # order or one ACCESS_TOKEN for all) are load balanced by
+        # CompletionsClient; see endpoint_router.py
+        self.endpoints = self._load_endpoints()
+        if self.endpoints:
+            self.completions = self.completions or self.endpoints[0].url
+            self.sg_token = self.sg_token or self.endpoints[0].token
+        self.routing = os.getenv('CODY_ROUTING', 'ewma')
+        self.breaker_failures = int(os.getenv('CODY_BREAKER_FAILURES', '5'))
+        self.breaker_cooldown = float(os.getenv('CODY_BREAKER_COOLDOWN', '30'))
+        # Hedged requests (see hedging.py): a duplicate is sent when no first
+        # byte arrived within this percentile of recent latency, for at most
+        # hedge_budget extra requests per request
+        self.hedging = os.getenv('CODY_HEDGING', 'false').lower() == 'true'
+        self.hedge_percentile = float(os.getenv('CODY_HEDGE_PERCENTILE', '0.95'))
+        self.hedge_budget = float(os.getenv('CODY_HEDGE_BUDGET', '0.1'))
+
+    def _load_endpoints(self):
+        urls = split_list(os.getenv('CODY_COMPLETIONS_ENDPOINTS'))
+        if not urls:
+            return []
+        tokens = split_list(os.getenv('ACCESS_TOKENS')) or [self.sg_token]
+        if len(tokens) == 1:
+            tokens = tokens * len(urls)
+        requests_per_minute = per_endpoint(os.getenv('CODY_ENDPOINT_REQUESTS_PER_MINUTE'), len(urls))
+        tokens_per_minute = per_endpoint(os.getenv('CODY_ENDPOINT_TOKENS_PER_MINUTE'), len(urls))
+        return [
+            Endpoint(url, token, rpm, tpm)
+            for url, token, rpm, tpm in zip(urls, tokens + [None] * len(urls), requests_per_minute, tokens_per_minute)
+        ]
+
+    def get_endpoints(self):
+        # The configured endpoints, or the single completions/sg_token pair
+        return self.endpoints or [Endpoint(self.completions, self.sg_token, None, None)]
+
+    @classmethod
+    def load(cls):
+        # One shared, memoized Config per process, for code that only reads it
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
 
     def validate(self):
         required = ['completions', 'sg_token', 'x_requested_with']
         missing = [attr for attr in required if not getattr(self, attr)]
         if missing:
             raise ValueError(f"Missing required configuration: {', '.join(missing)}")
+        unauthenticated = [endpoint.url for endpoint in self.get_endpoints() if not endpoint.token]
+        if unauthenticated:
+            raise ValueError(f"Missing access token for endpoint(s): {', '.join(unauthenticated)}")
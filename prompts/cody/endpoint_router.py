@@ -0,0 +1,214 @@
+import threading
+import time
+import requests
+from scheduler import TokenBucket, estimate_tokens, parse_retry_after
+
+# --------------------------------------------------------------
+# Routing completions requests across several endpoints
+# --------------------------------------------------------------
+# Config.endpoints lists the regional endpoints with their own tokens and
+# quotas. Every attempt (retries included) picks one:
+#
+#   ewma                 lowest peak-EWMA score: smoothed latency times
+#                        (outstanding requests + 1), so a slow or stalled
+#                        region quickly stops attracting traffic
+#   least_outstanding    fewest requests in flight, EWMA latency breaks ties
+#
+# Endpoints whose quota bucket would make the request wait are only used
+# when every endpoint would. A circuit breaker per endpoint ejects it after
+# `failure_threshold` consecutive failures; after `cooldown` seconds one trial
+# request is let through, and its success brings the endpoint back. The
+# last endpoint whose breaker is closed is never ejected: with nowhere else
+# to send requests, failing them all fast would only turn a burst of errors
+# into an outage. A 429 only parks the endpoint for its Retry-After.
+
+# Errors that say the endpoint itself is unhealthy, besides 5xx statuses
+ENDPOINT_FAILURES = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+)
+
+class NoEndpointAvailable(Exception):
+    # Every breaker is open; retry_after is when the first one lets a trial through
+    status_code = 503
+
+    def __init__(self, retry_after):
+        super().__init__(f"All completions endpoints are unavailable; retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.ejections = 0
+
+    def available(self, now):
+        if self.state == self.CLOSED:
+            return True
+        # Half-open admits only the one trial request already in flight
+        return self.state == self.OPEN and now >= self.opened_at + self.cooldown
+
+    def retry_in(self, now):
+        return max(0.0, self.opened_at + self.cooldown - now)
+
+    def selected(self):
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+
+    def record(self, success, now, can_open=True):
+        # can_open=False keeps a closed breaker closed whatever the failures
+        if success:
+            self.state = self.CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == self.CLOSED and not can_open:
+            return
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.ejections += 1
+            self.state = self.OPEN
+            self.opened_at = now
+
+class EndpointState:
+    def __init__(self, endpoint, failure_threshold, cooldown):
+        self.url = endpoint.url
+        self.token = endpoint.token
+        # Sent with every request, over the session's default Authorization
+        self.headers = {'Authorization': endpoint.token} if endpoint.token else {}
+        self.request_bucket = TokenBucket(endpoint.requests_per_minute) if endpoint.requests_per_minute else None
+        self.token_bucket = TokenBucket(endpoint.tokens_per_minute) if endpoint.tokens_per_minute else None
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.ewma_ms = None
+        self.outstanding = 0
+        self.parked_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def quota_wait(self, tokens):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens))
+        return wait
+
+    def reserve(self, tokens):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return wait
+
+class EndpointRouter:
+    POLICIES = ('ewma', 'least_outstanding')
+
+    def __init__(self, endpoints, policy='ewma', failure_threshold=5, cooldown=30.0, decay=0.3,
+                 clock=time.monotonic):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown routing policy '{policy}' (expected one of {', '.join(self.POLICIES)})")
+        if not endpoints:
+            raise ValueError("At least one completions endpoint is required")
+        self.endpoints = [EndpointState(endpoint, failure_threshold, cooldown) for endpoint in endpoints]
+        self.policy = policy
+        self.decay = decay
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get_endpoints(),
+            policy=config.routing,
+            failure_threshold=config.breaker_failures,
+            cooldown=config.breaker_cooldown,
+        )
+
+    def _score(self, endpoint, default_ms):
+        # Endpoints without a latency sample yet are assumed as fast as the
+        # fastest known one, and win ties with it, so each gets tried early;
+        # remaining ties go to the endpoint with the fewest requests
+        sampled = endpoint.ewma_ms is not None
+        latency = endpoint.ewma_ms if sampled else default_ms
+        if self.policy == 'least_outstanding':
+            return endpoint.outstanding, latency, sampled, endpoint.requests
+        return latency * (endpoint.outstanding + 1), endpoint.outstanding, sampled, endpoint.requests
+
+    def acquire(self, payload):
+        # Picks the endpoint for one attempt and counts it as outstanding;
+        # returns (endpoint, seconds to wait for its quota). Every acquire
+        # must be followed by release()
+        tokens = estimate_tokens(payload) if any(endpoint.token_bucket for endpoint in self.endpoints) else 0
+        with self._lock:
+            now = self.clock()
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint.breaker.available(now) and endpoint.parked_until <= now
+            ]
+            if not candidates:
+                candidates = [endpoint for endpoint in self.endpoints if endpoint.breaker.available(now)]
+            if not candidates:
+                raise NoEndpointAvailable(min(endpoint.breaker.retry_in(now) for endpoint in self.endpoints))
+            known = [endpoint.ewma_ms for endpoint in candidates if endpoint.ewma_ms is not None]
+            default_ms = min(known) if known else 1.0
+            endpoint = min(
+                candidates,
+                key=lambda endpoint: (endpoint.quota_wait(tokens), self._score(endpoint, default_ms)),
+            )
+            endpoint.breaker.selected()
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint, endpoint.reserve(tokens)
+
+    def release(self, endpoint, latency_ms=None, error=None):
+        # error: the exception the attempt failed with, if any. Only failures
+        # that say something about the endpoint (connection errors, timeouts,
+        # 5xx) count against its breaker. Anything else means the endpoint
+        # answered (a 4xx, a cancelled hedge, a body that didn't parse) and
+        # counts as a success, so a half-open trial always settles the breaker
+        status = getattr(error, 'status_code', None)
+        with self._lock:
+            now = self.clock()
+            endpoint.outstanding -= 1
+            if status is not None and status >= 500 or status is None and isinstance(error, ENDPOINT_FAILURES):
+                endpoint.errors += 1
+                can_open = any(
+                    other is not endpoint and other.breaker.state == CircuitBreaker.CLOSED
+                    for other in self.endpoints
+                )
+                endpoint.breaker.record(False, now, can_open)
+            else:
+                endpoint.breaker.record(True, now)
+                if status == 429:
+                    retry_after = parse_retry_after(getattr(error, 'retry_after', None))
+                    endpoint.parked_until = now + (1.0 if retry_after is None else retry_after)
+            # A timeout is a latency sample too: it is what makes a stalled
+            # region look slow before its breaker trips
+            if latency_ms is not None and (error is None or isinstance(error, requests.Timeout)):
+                if endpoint.ewma_ms is None:
+                    endpoint.ewma_ms = latency_ms
+                else:
+                    endpoint.ewma_ms += self.decay * (latency_ms - endpoint.ewma_ms)
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    'url': endpoint.url,
+                    'requests': endpoint.requests,
+                    'errors': endpoint.errors,
+                    'outstanding': endpoint.outstanding,
+                    'ewma_ms': endpoint.ewma_ms,
+                    'state': endpoint.breaker.state,
+                    'ejections': endpoint.breaker.ejections,
+                }
+                for endpoint in self.endpoints
+            ]
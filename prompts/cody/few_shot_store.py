@@ -0,0 +1,139 @@
+import json
+import re
+import zlib
+from collections import Counter, namedtuple
+import numpy as np
+
+# --------------------------------------------------------------
+# Few-shot example store with similarity-based selection
+# --------------------------------------------------------------
+# Examples are turned into TF-IDF vectors over hashed word unigrams and
+# bigrams (no network embeddings). The vectors are stored feature-major as an
+# inverted index, so scoring a query is a sparse matrix-vector product that
+# only touches the postings of the query's own features. Features that occur
+# in more than `max_df` of the examples (stop words) are skipped at query
+# time, which keeps selection well under a millisecond at 100k examples.
+
+Example = namedtuple('Example', ['text', 'label', 'score'])
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def extract_features(text):
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+class FewShotStore:
+    def __init__(self, examples=None, n_features=2 ** 20, max_df=0.5):
+        self.n_features = n_features
+        self.max_df = max_df
+        self.texts = []
+        self.labels = []
+        self._dirty = True
+        if examples:
+            self.extend(examples)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text, label):
+        self.texts.append(text)
+        self.labels.append(label)
+        self._dirty = True
+
+    def extend(self, examples):
+        # Accepts (text, label) pairs or {"text": ..., "label": ...} dicts
+        for example in examples:
+            if isinstance(example, dict):
+                self.add(example['text'], example['label'])
+            else:
+                self.add(*example)
+
+    def _hash(self, text):
+        counts = Counter(zlib.crc32(feature.encode('utf-8')) % self.n_features for feature in extract_features(text))
+        ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        tf = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        return ids, tf
+
+    def build(self):
+        hashed = [self._hash(text) for text in self.texts]
+        n_docs = len(hashed)
+        lengths = np.array([len(ids) for ids, _ in hashed], dtype=np.int64)
+        feature_ids = np.concatenate([ids for ids, _ in hashed]) if n_docs else np.zeros(0, np.int64)
+        tf = np.concatenate([weights for _, weights in hashed]) if n_docs else np.zeros(0, np.float32)
+        doc_ids = np.repeat(np.arange(n_docs, dtype=np.int32), lengths)
+
+        self.df = np.bincount(feature_ids, minlength=self.n_features).astype(np.int32)
+        self.idf = (np.log((1.0 + n_docs) / (1.0 + self.df)) + 1.0).astype(np.float32)
+        weights = tf * self.idf[feature_ids]
+        norms = np.sqrt(np.bincount(doc_ids, weights=weights * weights, minlength=n_docs))
+        weights = (weights / np.maximum(norms, 1e-12)[doc_ids]).astype(np.float32)
+
+        order = np.argsort(feature_ids, kind='stable')
+        self.postings_docs = doc_ids[order]
+        self.postings_weights = weights[order]
+        self.indptr = np.zeros(self.n_features + 1, dtype=np.int64)
+        np.cumsum(self.df, out=self.indptr[1:])
+        self._dirty = False
+
+    def scores(self, query):
+        if self._dirty:
+            self.build()
+        ids, tf = self._hash(query)
+        present = self.df[ids] > 0
+        ids, tf = ids[present], tf[present]
+        selective = self.df[ids] <= self.max_df * len(self.texts)
+        if selective.any():
+            ids, tf = ids[selective], tf[selective]
+        query_weights = tf * self.idf[ids]
+        query_weights /= max(float(np.sqrt(np.dot(query_weights, query_weights))), 1e-12)
+
+        starts, ends = self.indptr[ids], self.indptr[ids + 1]
+        docs = np.concatenate([self.postings_docs[start:end] for start, end in zip(starts, ends)] or [np.zeros(0, np.int32)])
+        weights = np.concatenate([
+            self.postings_weights[start:end] * weight
+            for start, end, weight in zip(starts, ends, query_weights)
+        ] or [np.zeros(0, np.float32)])
+        return np.bincount(docs, weights=weights, minlength=len(self.texts))
+
+    def select(self, query, k=3):
+        # Returns the k most similar examples, best first, with cosine scores
+        if not self.texts:
+            return []
+        scores = self.scores(query)
+        # Only examples sharing a feature with the query can rank; partitioning
+        # those is much cheaper than partitioning every score
+        candidates = np.flatnonzero(scores)
+        if len(candidates) == 0:
+            candidates = np.arange(len(scores))
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(scores[candidates], len(candidates) - k)[-k:]]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [Example(self.texts[i], self.labels[i], float(scores[i])) for i in top]
+
+    def save(self, path):
+        if self._dirty:
+            self.build()
+        np.savez(
+            path,
+            n_features=self.n_features,
+            max_df=self.max_df,
+            df=self.df,
+            idf=self.idf,
+            indptr=self.indptr,
+            postings_docs=self.postings_docs,
+            postings_weights=self.postings_weights,
+            examples=np.frombuffer(json.dumps([self.texts, self.labels]).encode('utf-8'), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        store = cls(n_features=int(data['n_features']), max_df=float(data['max_df']))
+        store.texts, store.labels = json.loads(data['examples'].tobytes().decode('utf-8'))
+        store.df = data['df']
+        store.idf = data['idf']
+        store.indptr = data['indptr']
+        store.postings_docs = data['postings_docs']
+        store.postings_weights = data['postings_weights']
+        store._dirty = False
+        return store
@@ -0,0 +1,151 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# --------------------------------------------------------------
+# Hedged requests: a second attempt when the first one is slow
+# --------------------------------------------------------------
+# For interactive calls the tail is what users feel. With a HedgingPolicy,
+# CompletionsClient starts every attempt on a worker thread and, once the
+# attempt is actually sending (not queued for a worker or waiting on a quota),
+# waits for its first byte (the response headers) for the `percentile` of
+# recent time-to-first-byte samples. If nothing has arrived by then, an
+# identical request is fired (the endpoint router sends it to the least
+# loaded endpoint) and whichever succeeds first is used. The loser is
+# cancelled: its response is closed as soon as it has one, dropping the
+# connection.
+#
+# Hedges are paid for from a budget: every request earns `budget` credits
+# (0.1 = at most ~10% extra requests in the long run) and a hedge costs one,
+# with at most `burst` credits saved up. A hedge must also be admitted by the
+# caller, which CompletionsClient only does when the rate limits allow one
+# more request right away.
+
+class HedgeCancelled(Exception):
+    pass
+
+class AttemptSignals:
+    # Shared by one attempt and HedgingPolicy.run. The attempt sets `started`
+    # when it is about to send and `first_byte` when the response headers
+    # arrive; run() sets `cancelled` once the other attempt has won. Both of
+    # the attempt's events are also set when it finishes, however it ends
+    def __init__(self):
+        self.started = threading.Event()
+        self.first_byte = threading.Event()
+        self.cancelled = threading.Event()
+
+    def finished(self, future):
+        self.started.set()
+        self.first_byte.set()
+
+class HedgingPolicy:
+    def __init__(self, percentile=0.95, budget=0.1, burst=10, window=100, min_samples=10,
+                 initial_delay=1.0, min_delay=0.01, max_workers=32):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.samples = deque(maxlen=window)
+        self.credits = float(burst)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cody-hedge')
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, max_workers=None):
+        # max_workers: attempts running at once, primaries and hedges alike;
+        # twice the caller's concurrency leaves room for every request to hedge
+        return cls(
+            percentile=config.hedge_percentile,
+            budget=config.hedge_budget,
+            max_workers=max_workers or 2 * config.pool_size,
+        )
+
+    def close(self):
+        # Losers still waiting on a stalled endpoint are left to time out
+        self._executor.shutdown(wait=False)
+
+    def observe(self, seconds):
+        # A time-to-first-byte sample from any attempt, hedge or not
+        with self._lock:
+            self.samples.append(seconds)
+
+    def delay(self):
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(self.samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+    def _spend(self, admit):
+        with self._lock:
+            if self.credits >= 1 and (admit is None or admit()):
+                self.credits -= 1
+                self.hedges += 1
+                return True
+            self.denied += 1
+            return False
+
+    def run(self, attempt, discard=None, admit=None):
+        # attempt(signals): one request that reports its progress through an
+        # AttemptSignals and gives up once signals.cancelled is set.
+        # discard(result) releases a loser's result (e.g. closes a stream).
+        # admit() is asked before a hedge is fired and may refuse it.
+        # Returns (result, info), info = {'hedged', 'hedge_won', 'hedge_delay_ms'}
+        with self._lock:
+            self.requests += 1
+            self.credits = min(self.burst, self.credits + self.budget)
+        delay = self.delay()
+        attempts = [self._start(attempt)]
+        future, signals = attempts[0]
+        signals.started.wait()
+        if signals.first_byte.wait(delay) or future.done() or not self._spend(admit):
+            return future.result(), {'hedged': False, 'hedge_won': False, 'hedge_delay_ms': None}
+        attempts.append(self._start(attempt))
+
+        pending = {future for future, _ in attempts}
+        winner = None
+        error = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = winner or future
+                elif error is None or future is attempts[0][0]:
+                    error = future.exception()
+        for future, signals in attempts:
+            if future is not winner:
+                signals.cancelled.set()
+                if discard is not None:
+                    future.add_done_callback(
+                        lambda future: future.exception() is None and discard(future.result())
+                    )
+        if winner is None:
+            raise error
+        won = winner is attempts[1][0]
+        if won:
+            with self._lock:
+                self.hedge_wins += 1
+        return winner.result(), {'hedged': True, 'hedge_won': won, 'hedge_delay_ms': delay * 1000}
+
+    def _start(self, attempt):
+        signals = AttemptSignals()
+        future = self._executor.submit(attempt, signals)
+        future.add_done_callback(signals.finished)
+        return future, signals
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'denied': self.denied,
+                'delay_ms': delay * 1000,
+            }
@@ -0,0 +1,188 @@
+import bisect
+import json
+import threading
+from collections import defaultdict
+
+# --------------------------------------------------------------
+# Instrumentation hooks for rendering and completions requests
+# --------------------------------------------------------------
+# PromptManager and CompletionsClient report what they did through
+# `instrumentation.emit(event, **fields)`. Nothing is recorded until a hook is
+# registered, e.g. the in-process MetricsAggregator:
+#
+#   metrics = MetricsAggregator()
+#   instrumentation.add_hook(metrics)
+#   ...
+#   print(metrics.to_prometheus())
+#
+# Events and their fields:
+#   render   template, render_ms, estimated_prompt_tokens (render_budgeted),
+#            prefix_cache_hit (render_split)
+#   request  template, endpoint, serialize_ms, ttfb_ms, total_ms, status,
+#            prompt_tokens, completion_tokens, cache_hit, shared,
+#            hedged, hedge_won, hedge_delay_ms (with a HedgingPolicy)
+#   stream   template, ttft_ms, total_ms, completion_tokens,
+#            cancelled (stream_structured)
+#   duplicate_lookup  template, duplicate_lookup_ms, duplicate_hit
+
+DEFAULT_BUCKETS_MS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+class Instrumentation:
+    def __init__(self):
+        self.hooks = []
+
+    def add_hook(self, hook):
+        # hook: callable(event, fields)
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @property
+    def enabled(self):
+        return bool(self.hooks)
+
+    def emit(self, event, **fields):
+        for hook in self.hooks:
+            try:
+                hook(event, fields)
+            except Exception:
+                # A broken hook must never fail a render or a request
+                pass
+
+instrumentation = Instrumentation()
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        # Linear interpolation inside the bucket holding the quantile
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class MetricsAggregator:
+    # Histograms of every *_ms field and totals of token counts, cache hits
+    # and statuses, all labelled by template name
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS, prefix='cody'):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.histograms = defaultdict(lambda: Histogram(self.buckets))
+        self.counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def __call__(self, event, fields):
+        template = fields.get('template') or 'unknown'
+        with self._lock:
+            self.counters[(f"{event}s", template, None)] += 1
+            for name, value in fields.items():
+                if value is None:
+                    continue
+                if name.endswith('_ms'):
+                    metric = name[:-3] if name.startswith(event) else f"{event}_{name[:-3]}"
+                    self.histograms[(metric, template)].observe(value)
+                elif name.endswith('_tokens'):
+                    self.counters[(name, template, None)] += value
+                elif name.endswith('_hit') and value:
+                    self.counters[(f"{name}s", template, None)] += 1
+                elif name == 'shared' and value:
+                    self.counters[('shared_requests', template, None)] += 1
+                elif name == 'cancelled' and value:
+                    self.counters[('cancelled_streams', template, None)] += 1
+                elif name == 'hedged' and value:
+                    self.counters[('hedged_requests', template, None)] += 1
+                elif name == 'hedge_won' and value:
+                    self.counters[('hedge_wins', template, None)] += 1
+                elif name == 'status':
+                    self.counters[(f"{event}_status", template, str(value))] += 1
+
+    def snapshot(self, reset=False):
+        # Plain-data copy of everything recorded, e.g. to send from a worker
+        # process to the parent's aggregator with merge()
+        with self._lock:
+            data = {
+                'histograms': {
+                    key: (list(histogram.counts), histogram.count, histogram.sum)
+                    for key, histogram in self.histograms.items()
+                },
+                'counters': dict(self.counters),
+            }
+            if reset:
+                self.histograms.clear()
+                self.counters.clear()
+        return data
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, (counts, count, total) in snapshot['histograms'].items():
+                histogram = self.histograms[key]
+                histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+            for key, value in snapshot['counters'].items():
+                self.counters[key] += value
+
+    def to_json(self):
+        with self._lock:
+            data = defaultdict(dict)
+            for (metric, template), histogram in self.histograms.items():
+                data[template][f"{metric}_ms"] = {
+                    'count': histogram.count,
+                    'mean': histogram.sum / histogram.count if histogram.count else 0.0,
+                    'p50': histogram.quantile(0.50),
+                    'p90': histogram.quantile(0.90),
+                    'p99': histogram.quantile(0.99),
+                }
+            for (metric, template, status), value in self.counters.items():
+                if status is None:
+                    data[template][metric] = value
+                else:
+                    data[template].setdefault(metric, {})[status] = value
+        return json.dumps(data, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            by_metric = defaultdict(list)
+            for (metric, template), histogram in sorted(self.histograms.items()):
+                by_metric[metric].append((template, histogram))
+            for metric, series in by_metric.items():
+                name = f"{self.prefix}_{metric}_milliseconds"
+                lines.append(f"# TYPE {name} histogram")
+                for template, histogram in series:
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                        lines.append(f'{name}_bucket{{template="{template}",le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{template="{template}"}} {histogram.sum:g}')
+                    lines.append(f'{name}_count{{template="{template}"}} {histogram.count}')
+
+            by_counter = defaultdict(list)
+            for (metric, template, status), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                by_counter[metric].append((template, status, value))
+            for metric, series in by_counter.items():
+                name = f"{self.prefix}_{metric}_total"
+                lines.append(f"# TYPE {name} counter")
+                for template, status, value in series:
+                    labels = f'template="{template}"' + (f',status="{status}"' if status is not None else '')
+                    lines.append(f"{name}{{{labels}}} {value:g}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,224 @@
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --------------------------------------------------------------
+# Local stand-in for the chat completions endpoint
+# --------------------------------------------------------------
+# Returns the same response shape the scripts parse
+# (choices[0].message.content) and, when the payload asks for
+# "stream": true, emits server-sent-event chunks with
+# choices[0].delta.content so streaming can be exercised offline.
+
+DEFAULT_REPLY = (
+    "This is a mock completion. The request contained {messages} message(s) "
+    "and asked for at most {max_tokens} tokens."
+)
+
+# Numbered items of a packed request (see request_packing.py); the default
+# reply answers each of them in its own section
+PACKED_ITEM = re.compile(r'^### Ticket (\d+)[ \t]*$', re.MULTILINE)
+
+# Schema and field order of a structured-output request (see
+# structured_output.py); the default reply is a JSON object with every
+# property in that order, the optional ones long like a model's reasoning
+OUTPUT_SCHEMA = re.compile(r'^JSON schema: (\{.*\})$', re.MULTILINE)
+FIELD_ORDER = re.compile(r'Write its fields in this order: (.*)\.$', re.MULTILINE)
+
+MOCK_VALUES = {'number': 0.9, 'integer': 1, 'boolean': True, 'array': [], 'object': {}, 'null': None}
+
+def structured_reply(schema, order=None):
+    required = set(schema.get('required', ()))
+    properties = schema.get('properties', {})
+    answer = {}
+    for name in order or properties:
+        spec = properties.get(name, {})
+        if 'enum' in spec:
+            answer[name] = spec['enum'][0]
+        elif spec.get('type', 'string') != 'string':
+            answer[name] = MOCK_VALUES.get(spec.get('type'))
+        elif name in required:
+            answer[name] = f"mock {name}"
+        else:
+            answer[name] = ' '.join([f"This is the mock {name}."] * 40)
+    return json.dumps(answer, indent=2)
+
+class MockSettings:
+    def __init__(self, latency=0.0, chunk_delay=0.0, reply=None,
+                 error_rate=0.0, error_statuses=(429, 503), retry_after=None, seed=None,
+                 tail_rate=0.0, tail_latency=0.0):
+        self.latency = latency
+        # Fraction of requests that take tail_latency instead, to reproduce a
+        # slow tail (a GC pause, a cold replica)
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.chunk_delay = chunk_delay
+        self.reply = reply or self.default_reply
+        # Fraction of requests answered with one of error_statuses instead,
+        # optionally carrying a Retry-After header
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        # Stream chunks actually written; a client that hangs up early stops it
+        self.streamed_tokens = 0
+        self.lock = threading.Lock()
+
+    def pick_error(self):
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return self.random.choice(self.error_statuses)
+        return None
+
+    def pick_latency(self):
+        with self.lock:
+            if self.tail_rate and self.random.random() < self.tail_rate:
+                return self.tail_latency
+        return self.latency
+
+    @staticmethod
+    def default_reply(payload):
+        messages = payload.get('messages') or [{}]
+        for message in messages:
+            content = message.get('content') or ''
+            schema = OUTPUT_SCHEMA.search(content)
+            if schema:
+                order = FIELD_ORDER.search(content)
+                return structured_reply(
+                    json.loads(schema.group(1)), json.loads(f"[{order.group(1)}]") if order else None
+                )
+        numbers = PACKED_ITEM.findall(messages[-1].get('content') or '')
+        if numbers:
+            return '\n\n'.join(
+                f"### Ticket {number}\nThis is a mock analysis of ticket {number}." for number in numbers
+            )
+        return DEFAULT_REPLY.format(
+            messages=len(payload.get('messages', [])),
+            max_tokens=payload.get('max_tokens'),
+        )
+
+class MockCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY every
+    # response would wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        settings = self.server.settings
+        with settings.lock:
+            settings.requests += 1
+
+        status = settings.pick_error()
+        if status is not None:
+            headers = {}
+            if settings.retry_after is not None:
+                headers['Retry-After'] = str(settings.retry_after)
+            self._send_json(status, {'error': f"injected {status} error"}, headers)
+            return
+
+        latency = settings.pick_latency()
+        if latency:
+            time.sleep(latency)
+        content = settings.reply(payload)
+
+        if payload.get('stream'):
+            self._send_stream(content, settings.chunk_delay)
+        else:
+            self._send_json(200, {
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'completion_tokens': len(tokenize(content))},
+            })
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, content, chunk_delay):
+        # Chunked transfer encoding, like real SSE endpoints, so every event
+        # reaches the client as soon as it is written
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for token in tokenize(content):
+            event = {'choices': [{'index': 0, 'delta': {'content': token}}]}
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            with self.server.settings.lock:
+                self.server.settings.streamed_tokens += 1
+            if chunk_delay:
+                time.sleep(chunk_delay)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+class MockCompletionsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that hang up mid-stream (cancelled or hedged requests) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def tokenize(content):
+    # Word-sized chunks with their trailing whitespace, so joining them
+    # reproduces the original text exactly
+    return re.findall(r'\S+\s*|\s+', content)
+
+def start_mock_server(host='127.0.0.1', port=0, **settings):
+    # Runs the server on a daemon thread; port=0 picks a free port.
+    # The endpoint URL is available as server.url
+    server = MockCompletionsServer((host, port), MockCompletionsHandler)
+    server.settings = MockSettings(**settings)
+    server.url = f"http://{host}:{server.server_address[1]}/.api/llm/chat/completions"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local mock chat completions endpoint")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before responding")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, action='append', help="status code(s) for injected errors")
+    parser.add_argument('--retry-after', help="Retry-After header sent with injected errors")
+    parser.add_argument('--tail-rate', type=float, default=0.0, help="fraction of requests that are slow")
+    parser.add_argument('--tail-latency', type=float, default=0.0, help="seconds before responding to slow requests")
+    args = parser.parse_args()
+
+    server = MockCompletionsServer((args.host, args.port), MockCompletionsHandler)
+    server.settings = MockSettings(
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        error_statuses=args.error_status or (429, 503),
+        retry_after=args.retry_after,
+        tail_rate=args.tail_rate,
+        tail_latency=args.tail_latency,
+    )
+    print(f"Mock completions endpoint: http://{args.host}:{args.port}/.api/llm/chat/completions")
+    server.serve_forever()
@@ -0,0 +1,236 @@
+import json
+import os
+import re
+import time
+import zlib
+from collections import namedtuple
+import numpy as np
+from instrumentation import instrumentation
+
+# --------------------------------------------------------------
+# Near-duplicate index: reuse analyses of almost identical tickets
+# --------------------------------------------------------------
+# Every text is reduced to word shingles (overlapping n-grams) and a MinHash
+# signature: for each of `num_perm` hash functions, the smallest hash of any
+# shingle. Two signatures agree on a position with probability equal to the
+# Jaccard similarity of the shingle sets, so the fraction of equal positions
+# estimates it.
+#
+# Lookups are sub-linear through LSH banding: the signature is cut into
+# `bands` bands and only entries sharing at least one whole band with the
+# query are compared. Per band, the band hashes of all entries are kept in a
+# sorted array (searched with np.searchsorted); entries added since the last
+# merge sit in a small dict until there are enough of them to re-sort.
+#
+# Entries carry a scope (e.g. the ticket pipeline), and only entries with the
+# same scope can match.
+
+Match = namedtuple('Match', ['key', 'result', 'similarity'])
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+# Order numbers, amounts and dates are masked, so they don't tell tickets apart
+DIGITS_PATTERN = re.compile(r"\d+")
+
+def shingles(text, size=3):
+    words = WORD_PATTERN.findall(DIGITS_PATTERN.sub('0', text.lower()))
+    if len(words) <= size:
+        return [' '.join(words)]
+    return [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+def choose_bands(num_perm, threshold):
+    # The fewest bands whose LSH S-curve midpoint, roughly (1/bands) ** (1/rows),
+    # is at or below the threshold: pairs just above it still become candidates
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands == 0 and (1.0 / bands) ** (bands / num_perm) <= threshold:
+            return bands
+    return num_perm
+
+class NearDuplicateIndex:
+    def __init__(self, threshold=0.8, num_perm=128, bands=None, shingle_size=3, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands or choose_bands(num_perm, threshold)
+        if num_perm % self.bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({self.bands})")
+        self.rows = num_perm // self.bands
+        self.shingle_size = shingle_size
+        self.seed = seed
+        # Multiply-shift hash family: ((a * x + b) mod 2**64) >> 32, a odd
+        random = np.random.default_rng(seed)
+        self._a = random.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = random.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self._band_mix = random.integers(1, 2 ** 63, size=self.rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+        self._size = 0
+        self.signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self.band_keys = np.zeros((0, self.bands), dtype=np.uint64)
+        self.scopes = np.zeros(0, dtype=np.uint32)
+        self.keys = []
+        self.results = []
+        self._sorted_count = 0
+        self._sorted_keys = np.zeros((self.bands, 0), dtype=np.uint64)
+        self._sorted_ids = np.zeros((self.bands, 0), dtype=np.int64)
+        self._recent = {}
+
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return self._size
+
+    def signature(self, text):
+        hashed = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text, self.shingle_size)),
+            dtype=np.uint64,
+        )
+        with np.errstate(over='ignore'):
+            values = (hashed[:, None] * self._a + self._b) >> np.uint64(32)
+        return values.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signatures):
+        banded = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        with np.errstate(over='ignore'):
+            return (banded * self._band_mix).sum(axis=2, dtype=np.uint64)
+
+    @staticmethod
+    def _scope(scope):
+        return zlib.crc32(json.dumps(scope, sort_keys=True, default=repr).encode('utf-8'))
+
+    def _grow(self, needed):
+        capacity = len(self.scopes)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 64)
+        for name in ('signatures', 'band_keys', 'scopes'):
+            current = getattr(self, name)
+            grown = np.zeros((capacity,) + current.shape[1:], dtype=current.dtype)
+            grown[:self._size] = current[:self._size]
+            setattr(self, name, grown)
+
+    def _merge(self):
+        # Re-sorts the per-band arrays over every entry and empties _recent
+        keys = self.band_keys[:self._size].T
+        order = np.argsort(keys, axis=1, kind='stable')
+        self._sorted_keys = np.ascontiguousarray(np.take_along_axis(keys, order, axis=1))
+        self._sorted_ids = np.ascontiguousarray(order)
+        self._sorted_count = self._size
+        self._recent = {}
+
+    def empty(self):
+        # A new index hashing the same way, so signatures compare across both
+        return type(self)(self.threshold, self.num_perm, self.bands, self.shingle_size, self.seed)
+
+    def add(self, text, result, key=None, scope=None):
+        self._grow(self._size + 1)
+        signature = self.signature(text)
+        band_keys = self._band_keys(signature[None, :])[0]
+        entry = self._size
+        self.signatures[entry] = signature
+        self.band_keys[entry] = band_keys
+        self.scopes[entry] = self._scope(scope)
+        self.keys.append(key)
+        self.results.append(result)
+        self._size += 1
+        for band, band_key in enumerate(band_keys.tolist()):
+            self._recent.setdefault((band, band_key), []).append(entry)
+        if self._size - self._sorted_count > max(1024, self._sorted_count // 8):
+            self._merge()
+        return entry
+
+    def candidates(self, band_keys):
+        found = []
+        for band, band_key in enumerate(band_keys):
+            sorted_keys = self._sorted_keys[band]
+            start = np.searchsorted(sorted_keys, band_key, side='left')
+            end = np.searchsorted(sorted_keys, band_key, side='right')
+            if end > start:
+                found.append(self._sorted_ids[band, start:end])
+            recent = self._recent.get((band, int(band_key)))
+            if recent:
+                found.append(np.array(recent, dtype=np.int64))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def query(self, text, scope=None, signature=None):
+        # Best match at or above the threshold, or None; doesn't count as a lookup
+        if not self._size:
+            return None
+        signature = self.signature(text) if signature is None else signature
+        candidates = self.candidates(self._band_keys(signature[None, :])[0])
+        candidates = candidates[self.scopes[candidates] == self._scope(scope)]
+        if not len(candidates):
+            return None
+        similarity = (self.signatures[candidates] == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        if similarity[best] < self.threshold:
+            return None
+        entry = int(candidates[best])
+        return Match(self.keys[entry], self.results[entry], float(similarity[best]))
+
+    def lookup(self, text, scope=None, template=None, pending=None):
+        # query() plus hit-rate accounting; template only labels the event.
+        # pending: an index from empty() of texts whose answers are still on
+        # their way, consulted when this one has no match
+        start = time.perf_counter()
+        signature = self.signature(text)
+        match = self.query(text, scope, signature)
+        if match is None and pending is not None:
+            match = pending.query(text, scope, signature)
+        self.lookups += 1
+        self.hits += match is not None
+        if instrumentation.enabled:
+            instrumentation.emit(
+                'duplicate_lookup',
+                template=template,
+                duplicate_lookup_ms=(time.perf_counter() - start) * 1000,
+                duplicate_hit=match is not None,
+            )
+        return match
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+    def save(self, path):
+        # Written to a temporary file first, so a crash never leaves a torn index
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(
+                file,
+                params=np.array([self.num_perm, self.bands, self.shingle_size, self.seed], dtype=np.int64),
+                threshold=self.threshold,
+                signatures=self.signatures[:self._size],
+                scopes=self.scopes[:self._size],
+                entries=np.frombuffer(json.dumps([self.keys, self.results]).encode('utf-8'), dtype=np.uint8),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, threshold=None):
+        # A different threshold needs its own banding: the band keys are
+        # rebuilt from the saved signatures below, so candidates near the new
+        # threshold aren't missed
+        data = np.load(path)
+        num_perm, bands, shingle_size, seed = (int(value) for value in data['params'])
+        saved_threshold = float(data['threshold'])
+        if threshold is not None and threshold != saved_threshold:
+            bands = None
+        index = cls(
+            threshold=saved_threshold if threshold is None else threshold,
+            num_perm=num_perm,
+            bands=bands,
+            shingle_size=shingle_size,
+            seed=seed,
+        )
+        index.keys, index.results = json.loads(data['entries'].tobytes().decode('utf-8'))
+        index.signatures = data['signatures']
+        index.scopes = data['scopes']
+        index._size = len(index.scopes)
+        index.band_keys = index._band_keys(index.signatures)
+        index._merge()
+        return index
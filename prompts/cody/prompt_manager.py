@@ -1,49 +1,572 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from pathlib import Path
-import frontmatter
-from jinja2 import Environment, FileSystemLoader, StrictUndefined, TemplateError, meta
+from jinja2 import (
+    Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader, StrictUndefined, TemplateError,
+    TemplateNotFound, meta,
+)
+from jinja2.runtime import Macro
+from instrumentation import instrumentation
+from structured_output import format_instructions
+from template_registry import (
+    TemplateRegistry, find_required_variables, parse_frontmatter, split_frontmatter, split_static_prefix,
+)
+from token_budget import MESSAGE_OVERHEAD, default_counter, fit_policy, render_within_budget, truncate_variables
+
+# Compiled template code is cached here across processes, so a cold worker
+# skips Jinja compilation; CODY_BYTECODE_CACHE="" turns it off
+DEFAULT_BYTECODE_CACHE = Path(__file__).parent / "templates" / ".bytecode_cache"
+
+class SplitPrompt(namedtuple("SplitPrompt", ["prefix", "text", "prompt_tokens", "max_tokens", "truncated"])):
+    __slots__ = ()
+
+    def messages(self):
+        # The shared prefix goes first as a system message, byte-for-byte the
+        # same for every item, so endpoint-side prompt caching can match it
+        messages = [{"role": "system", "content": self.prefix}] if self.prefix else []
+        return messages + [{"role": "user", "content": self.text}]
+
+class _CachedTemplate:
+    # Everything get_prompt/render_many need from a template file, so that a
+    # cache hit skips file I/O and Jinja compilation entirely. The frontmatter
+    # metadata and the variable analysis are worked out on first use, so a
+    # plain render never imports YAML or parses the template a second time.
+    def __init__(self, env, path, mtime_ns, size, digest, header, content, compiled):
+        self.env = env
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.header = header
+        self.content = content
+        self.compiled = compiled
+        self._metadata = None
+        self._variables = None
+        self._required_variables = None
+        self._splits = {}
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = parse_frontmatter(self.header)
+        return self._metadata
+
+    def _analyse(self):
+        ast = self.env.parse(self.content)
+        variables = meta.find_undeclared_variables(ast)
+        self._required_variables = find_required_variables(ast, variables)
+        self._variables = variables
+
+    @property
+    def variables(self):
+        if self._variables is None:
+            self._analyse()
+        return self._variables
+
+    @property
+    def required_variables(self):
+        if self._required_variables is None:
+            self._analyse()
+        return self._required_variables
+
+    def split(self, dynamic):
+        # (prefix, tail, prefix variables) compiled for a set of dynamic
+        # variables, or None when the template has no static prefix
+        key = tuple(sorted(dynamic))
+        if key not in self._splits:
+            parts = split_static_prefix(self.env.parse(self.content), key)
+            if parts is not None:
+                prefix, tail = parts
+                parts = (
+                    self.env.from_string(prefix),
+                    self.env.from_string(tail),
+                    frozenset(meta.find_undeclared_variables(prefix)),
+                )
+            self._splits[key] = parts
+        return self._splits[key]
+
+class _CompiledEntry:
+    # Stand-in for _CachedTemplate when rendering from modules written by
+    # PromptManager.compile_templates(): the metadata, the variable analysis
+    # and the static prefix split come from the manifest written alongside
+    # the modules, so no template source is read or parsed
+    def __init__(self, env, name, info):
+        self.env = env
+        self.name = name
+        self.digest = info["digest"]
+        self._metadata = info["frontmatter"]
+        self.variables = frozenset(info["variables"])
+        self.required_variables = frozenset(info["required_variables"])
+        self.compiled = env.get_template(f"{name}.j2")
+        self._split = info.get("split")
+        self._splits = {}
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    def split(self, dynamic):
+        key = tuple(sorted(dynamic))
+        if self._split is None or key != tuple(self._split["dynamic"]):
+            # Only the frontmatter's dynamic_variables split is compiled ahead
+            # of time; any other one is worked out from the source
+            return PromptManager._load(self.name).split(dynamic)
+        if key not in self._splits:
+            self._splits[key] = (
+                self.env.get_template(_split_module_name(self.name, "prefix")),
+                self.env.get_template(_split_module_name(self.name, "tail")),
+                frozenset(self._split["prefix_variables"]),
+            )
+        return self._splits[key]
+
+def _split_module_name(template, part):
+    return f"{template}.j2#{part}"
+
+# Written by compile_templates() next to the compiled modules
+COMPILED_MANIFEST = "manifest.json"
+
+class FrontmatterLoader(FileSystemLoader):
+    # Serves template bodies without their YAML frontmatter, so templates can
+    # also be loaded with env.get_template() and compiled ahead of time
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return split_frontmatter(source)[1], filename, uptodate
+
+def _bytecode_cache():
+    directory = os.getenv("CODY_BYTECODE_CACHE", str(DEFAULT_BYTECODE_CACHE))
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory)
 
 class PromptManager:
     _env = None
-    
+    _compiled_env = None
+    _compiled_manifest = {}
+    _compiled_entries = {}
+    _registry = None
+    _macro_tables = {}
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    _cache_maxsize = 128
+    _cache_hits = 0
+    _cache_misses = 0
+    _prefix_cache = OrderedDict()
+    _prefix_cache_maxsize = 256
+
     @classmethod
     def _get_env(cls, templates_dir="templates"):
-        templates_dir = Path(__file__).parent / templates_dir
         if cls._env is None:
             cls._env = Environment(
-                loader=FileSystemLoader(templates_dir),
+                loader=FrontmatterLoader(Path(__file__).parent / templates_dir),
                 undefined=StrictUndefined,
+                bytecode_cache=_bytecode_cache(),
             )
         return cls._env
-    
+
+    @classmethod
+    def get_registry(cls):
+        if cls._registry is None:
+            env = cls._get_env()
+            cls._registry = TemplateRegistry(env.loader.searchpath[0], env)
+        return cls._registry
+
     @staticmethod
-    def get_prompt(template, **kwargs):
-        env = PromptManager._get_env()
+    def _compile(env, name, filename, content):
+        # Same steps as Jinja's own loader: reuse compiled code from the
+        # bytecode cache when the source is unchanged, else compile and store it
+        bcc = env.bytecode_cache
+        code = None
+        if bcc is not None:
+            bucket = bcc.get_bucket(env, name, filename, content)
+            code = bucket.code
+        if code is None:
+            code = env.compile(content, name, filename)
+            if bcc is not None:
+                bucket.code = code
+                try:
+                    bcc.set_bucket(bucket)
+                except OSError:
+                    # An unwritable cache directory only costs the speedup
+                    pass
+        return env.template_class.from_code(env, code, env.make_globals(None), None)
+
+    @classmethod
+    def _load(cls, template):
+        env = cls._get_env()
+        with cls._cache_lock:
+            entry = cls._cache.get(template)
+
+        if entry is not None:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            if stat is not None:
+                if stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size:
+                    return cls._record_hit(template, entry)
+                # The file was touched; only recompile if the content really changed
+                with open(entry.path, "rb") as file:
+                    raw = file.read()
+                if hashlib.sha256(raw).hexdigest() == entry.digest:
+                    entry.mtime_ns = stat.st_mtime_ns
+                    entry.size = stat.st_size
+                    return cls._record_hit(template, entry)
+
         template_path = f"{template}.j2"
-        source_path = env.loader.get_source(env, template_path)[1]
-        with open(source_path) as file:
-            post = frontmatter.load(file)
-            
-        template = env.from_string(post.content)
+        source_path = os.path.join(env.loader.searchpath[0], template_path)
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            raise TemplateNotFound(template_path)
+        with open(source_path, "rb") as file:
+            raw = file.read()
+        header, content = split_frontmatter(raw.decode("utf-8"))
+        entry = _CachedTemplate(
+            env,
+            path=source_path,
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            digest=hashlib.sha256(raw).hexdigest(),
+            header=header,
+            content=content,
+            compiled=cls._compile(env, template_path, source_path, content),
+        )
+
+        with cls._cache_lock:
+            cls._cache_misses += 1
+            cls._cache[template] = entry
+            cls._cache.move_to_end(template)
+            while len(cls._cache) > cls._cache_maxsize:
+                cls._cache.popitem(last=False)
+        return entry
+
+    @classmethod
+    def get_metadata(cls, template):
+        # Frontmatter of a template. The registry index already holds it as
+        # JSON, so YAML is only parsed for templates changed since indexing
+        entry = cls._entry(template)
+        if entry._metadata is None:
+            indexed = cls.get_registry().get(template)
+            if indexed["digest"] == entry.digest:
+                entry._metadata = indexed["frontmatter"]
+        return entry.metadata
+
+    @classmethod
+    def _record_hit(cls, template, entry):
+        with cls._cache_lock:
+            cls._cache_hits += 1
+            cls._cache[template] = entry
+            cls._cache.move_to_end(template)
+        return entry
+
+    @classmethod
+    def cache_info(cls):
+        with cls._cache_lock:
+            return {
+                "hits": cls._cache_hits,
+                "misses": cls._cache_misses,
+                "size": len(cls._cache),
+                "maxsize": cls._cache_maxsize,
+            }
+
+    @classmethod
+    def cache_clear(cls, maxsize=None):
+        with cls._cache_lock:
+            cls._cache.clear()
+            cls._prefix_cache.clear()
+            cls._cache_hits = 0
+            cls._cache_misses = 0
+            if maxsize is not None:
+                cls._cache_maxsize = maxsize
+
+    @classmethod
+    def _entry(cls, template):
+        # The template as every render path sees it: from the compiled modules
+        # after use_compiled_templates(), else from the cached source
+        if cls._compiled_env is None:
+            return cls._load(template)
+        entry = cls._compiled_entries.get(template)
+        if entry is None:
+            info = cls._compiled_manifest.get(template)
+            if info is None:
+                raise TemplateNotFound(f"{template}.j2")
+            entry = _CompiledEntry(cls._compiled_env, template, info)
+            cls._compiled_entries[template] = entry
+        return entry
+
+    @classmethod
+    def _compiled(cls, template):
+        return cls._entry(template).compiled
+
+    @classmethod
+    def compile_templates(cls, target_dir):
+        # Ahead-of-time compiles every template to a Python module in target_dir,
+        # along with the static prefix split for its frontmatter's
+        # dynamic_variables and a manifest of its metadata and variables
+        env = cls._get_env()
+        env.compile_templates(
+            str(target_dir),
+            zip=None,
+            filter_func=lambda name: name.endswith(".j2"),
+            ignore_errors=False,
+        )
+        manifest = {}
+        for indexed in cls.get_registry().list_templates():
+            name = indexed["name"]
+            info = {
+                key: indexed[key]
+                for key in ("digest", "frontmatter", "variables", "required_variables")
+            }
+            dynamic = tuple(sorted(indexed["frontmatter"].get("dynamic_variables") or ()))
+            entry = cls._load(name)
+            parts = split_static_prefix(env.parse(entry.content), dynamic) if dynamic else None
+            if parts is not None:
+                for part, node in zip(("prefix", "tail"), parts):
+                    module_name = _split_module_name(name, part)
+                    code = env.compile(node, module_name, entry.path, True, True)
+                    with open(os.path.join(target_dir, ModuleLoader.get_module_filename(module_name)), "w") as file:
+                        file.write(code)
+                info["split"] = {
+                    "dynamic": dynamic,
+                    "prefix_variables": sorted(meta.find_undeclared_variables(parts[0])),
+                }
+            manifest[name] = info
+        with open(os.path.join(target_dir, COMPILED_MANIFEST), "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True, default=str)
+
+    @classmethod
+    def use_compiled_templates(cls, target_dir=None):
+        # Renders from modules written by compile_templates(), so a cold process
+        # skips reading and parsing template sources entirely. The modules are
+        # a build artifact: they are not checked against the sources.
+        # Pass None to go back to rendering from the template files.
+        cls._compiled_env = None
+        cls._compiled_manifest = {}
+        cls._compiled_entries = {}
+        if target_dir is not None:
+            with open(os.path.join(target_dir, COMPILED_MANIFEST)) as file:
+                cls._compiled_manifest = json.load(file)
+            cls._compiled_env = Environment(
+                loader=ModuleLoader(str(target_dir)),
+                undefined=StrictUndefined,
+            )
+        cls._macro_tables.clear()
+
+    @classmethod
+    def get_macros(cls, library):
+        # name -> callable table of the macros a library template such as
+        # prompts.j2 exports; built once per compiled template
+        compiled = cls._compiled(library)
+        cached = cls._macro_tables.get(library)
+        if cached is not None and cached[0] is compiled:
+            return cached[1]
+        module = compiled.module
+        table = {
+            name: value
+            for name, value in vars(module).items()
+            if isinstance(value, Macro)
+        }
+        cls._macro_tables[library] = (compiled, table)
+        return table
+
+    @staticmethod
+    def render_macro(library, macro, **kwargs):
+        start = time.perf_counter()
+        macros = PromptManager.get_macros(library)
+        if macro not in macros:
+            raise ValueError(f"Unknown macro '{macro}' in template '{library}'")
+        try:
+            prompt = str(macros[macro](**kwargs))
+        except TemplateError as e:
+            raise ValueError(f"Error rendering template: {str(e)}")
+        if instrumentation.enabled:
+            instrumentation.emit(
+                "render", template=f"{library}.{macro}", render_ms=(time.perf_counter() - start) * 1000
+            )
+        return prompt
+
+    @staticmethod
+    def render_macros(library, calls):
+        # Batched invocation: calls is an iterable of (macro name, kwargs);
+        # yields one rendered prompt per call
+        macros = PromptManager.get_macros(library)
+        for macro, kwargs in calls:
+            if macro not in macros:
+                raise ValueError(f"Unknown macro '{macro}' in template '{library}'")
+            try:
+                yield str(macros[macro](**kwargs))
+            except TemplateError as e:
+                raise ValueError(f"Error rendering template: {str(e)}")
+
+    @staticmethod
+    def get_prompt(template, **kwargs):
+        start = time.perf_counter()
+        compiled = PromptManager._compiled(template)
+        try:
+            prompt = compiled.render(**kwargs)
+        except TemplateError as e:
+            raise ValueError(f"Error rendering template: {str(e)}")
+        if instrumentation.enabled:
+            instrumentation.emit("render", template=template, render_ms=(time.perf_counter() - start) * 1000)
+        return prompt
+
+    @staticmethod
+    def render_budgeted(template, context_window=None, max_tokens=None, counter=None, **kwargs):
+        # Applies the frontmatter `budget` policy: overlong variables are cut
+        # down, the prompt is measured and max_tokens is fitted to the context
+        # window. Returns a BudgetedPrompt; raises PromptBudgetError when the
+        # prompt can't fit
+        start = time.perf_counter()
+        entry = PromptManager._entry(template)
+        prompt = render_within_budget(
+            entry.compiled,
+            kwargs,
+            policy=PromptManager.get_metadata(template).get("budget"),
+            counter=counter,
+            context_window=context_window,
+            max_tokens=max_tokens,
+        )
+        if instrumentation.enabled:
+            instrumentation.emit(
+                "render",
+                template=template,
+                render_ms=(time.perf_counter() - start) * 1000,
+                estimated_prompt_tokens=prompt.prompt_tokens,
+            )
+        return prompt
+
+    @classmethod
+    def _render_prefix(cls, template, entry, parts, variables, counter, suffix=""):
+        # Rendered once per template version, tokenizer and values of the
+        # variables the prefix actually uses; returns (text, tokens, cache hit).
+        # A suffix (structured output instructions) is appended to the text
+        compiled, _, names = parts
+        static = {name: variables[name] for name in names if name in variables}
+        key = (
+            template,
+            entry.digest,
+            id(counter.tokenizer),
+            json.dumps(static, sort_keys=True, default=repr),
+            suffix,
+        )
+        with cls._cache_lock:
+            cached = cls._prefix_cache.get(key)
+            if cached is not None:
+                cls._prefix_cache.move_to_end(key)
+                return cached + (True,)
         try:
-            return template.render(**kwargs)
+            text = compiled.render(**static).strip() if compiled is not None else ""
         except TemplateError as e:
             raise ValueError(f"Error rendering template: {str(e)}")
-    
+        if suffix:
+            text = f"{text}\n\n{suffix}" if text else suffix
+        cached = (text, counter.count(text))
+        with cls._cache_lock:
+            cls._prefix_cache[key] = cached
+            while len(cls._prefix_cache) > cls._prefix_cache_maxsize:
+                cls._prefix_cache.popitem(last=False)
+        return cached + (False,)
+
+    @staticmethod
+    def render_split(template, context_window=None, max_tokens=None, counter=None, dynamic=None, structured=False,
+                     **kwargs):
+        # render_budgeted for templates with a large static preamble. The part
+        # before the first `dynamic` variable (default: the frontmatter's
+        # dynamic_variables) is rendered once per combination of static values
+        # and cached; per item only the dynamic tail is rendered. Returns a
+        # SplitPrompt; templates without a static prefix come back whole in
+        # `text` with an empty `prefix`. With structured=True the prefix also
+        # asks for a JSON answer matching the frontmatter's output_schema (see
+        # structured_output.py)
+        start = time.perf_counter()
+        counter = counter or default_counter
+        entry = PromptManager._entry(template)
+        metadata = PromptManager.get_metadata(template)
+        policy = metadata.get("budget")
+        dynamic = dynamic or metadata.get("dynamic_variables") or ()
+        parts = entry.split(dynamic) if dynamic else None
+        variables, truncated = truncate_variables(kwargs, policy, counter)
+        suffix = ""
+        if structured:
+            if not metadata.get("output_schema"):
+                raise ValueError(f"Template '{template}' declares no output_schema")
+            suffix = format_instructions(metadata["output_schema"])
+
+        prefix, prefix_tokens, prefix_hit = "", 0, None
+        try:
+            if parts is None:
+                text = entry.compiled.render(**variables)
+                if suffix:
+                    prefix, prefix_tokens, prefix_hit = PromptManager._render_prefix(
+                        template, entry, (None, None, ()), variables, counter, suffix
+                    )
+            else:
+                prefix, prefix_tokens, prefix_hit = PromptManager._render_prefix(
+                    template, entry, parts, variables, counter, suffix
+                )
+                text = parts[1].render(**variables)
+        except TemplateError as e:
+            raise ValueError(f"Error rendering template: {str(e)}")
+        text = text.strip()
+
+        prompt_tokens = counter.count_messages([{"content": text}])
+        if prefix:
+            prompt_tokens += MESSAGE_OVERHEAD + prefix_tokens
+        max_tokens = fit_policy(prompt_tokens, policy, context_window, max_tokens)
+        if instrumentation.enabled:
+            instrumentation.emit(
+                "render",
+                template=template,
+                render_ms=(time.perf_counter() - start) * 1000,
+                estimated_prompt_tokens=prompt_tokens,
+                prefix_cache_hit=prefix_hit,
+            )
+        return SplitPrompt(prefix, text, prompt_tokens, max_tokens, truncated)
+
+    @staticmethod
+    def render_many(template, variable_sets):
+        # Lazily renders one prompt per variable dict; the template is resolved,
+        # compiled and its required variables computed once for the whole batch
+        entry = PromptManager._entry(template)
+        compiled = entry.compiled
+        required = entry.required_variables
+        for index, kwargs in enumerate(variable_sets):
+            missing = required.difference(kwargs)
+            if missing:
+                raise ValueError(
+                    f"Error rendering template: item {index} is missing {', '.join(sorted(missing))}"
+                )
+            start = time.perf_counter()
+            try:
+                prompt = compiled.render(**kwargs)
+            except TemplateError as e:
+                raise ValueError(f"Error rendering template: item {index}: {str(e)}")
+            if instrumentation.enabled:
+                instrumentation.emit("render", template=template, render_ms=(time.perf_counter() - start) * 1000)
+            yield prompt
+
     @staticmethod
     def get_template_info(template):
-        env = PromptManager._get_env()
-        template_path = f"{template}.j2"
-        source_path = env.loader.get_source(env, template_path)[1]
-        with open(source_path) as file:
-            post = frontmatter.load(file)
-            
-        ast = env.parse(post.content)
-        variables = meta.find_undeclared_variables(ast)
-        
+        entry = PromptManager.get_registry().get(template)
+
         return {
             "name": template,
-            "description": post.metadata.get("description", "No description provided"),
-            "author": post.metadata.get("author", "Unknown"),
-            "variables": list(variables),
-            "frontmatter": post.metadata,
-        }
\ No newline at end of file
+            "description": entry["description"],
+            "author": entry["author"],
+            "variables": list(entry["variables"]),
+            "required_variables": list(entry["required_variables"]),
+            "macros": dict(entry["macros"]),
+            "frontmatter": dict(entry["frontmatter"]),
+        }
+
+    @staticmethod
+    def list_templates():
+        return PromptManager.get_registry().list_templates()
@@ -0,0 +1,186 @@
+import json
+import re
+from collections import namedtuple
+from itertools import islice
+from prompt_manager import PromptManager
+from token_budget import default_counter, truncate_variables
+
+# --------------------------------------------------------------
+# Request packing: several items answered by one completion call
+# --------------------------------------------------------------
+# A template opts in through its frontmatter, e.g. ticket_analysis:
+#
+#   packing:
+#     template: ticket_analysis_packed   # renders `items` as numbered sections
+#     variable: ticket                   # the per-item variable
+#     max_items: 8
+#     completion_tokens_per_item: 250
+#
+# Rows that render the same static variables (pipeline, name, company) are
+# bin-packed into requests up to the packed template's prompt budget. The
+# answer is split back into one result per item at its "### Ticket <n>"
+# heading; items whose section is missing or empty, and every item of a
+# packed request that failed outright, are sent again as single requests.
+
+SECTION_PATTERN = re.compile(r"^[ \t]*#{1,6}[ \t]*Ticket[ \t]+(\d+)\b[^\n]*$", re.IGNORECASE | re.MULTILINE)
+
+# Tokens the numbered heading around every packed item costs
+ITEM_OVERHEAD = 8
+
+_Item = namedtuple('_Item', ['index', 'variables', 'tokens'])
+_Job = namedtuple('_Job', ['payload', 'items'])
+
+def split_packed_response(text, count):
+    # {item number: section text} for the items 1..count found in the answer;
+    # the first section wins when a number repeats
+    sections = {}
+    matches = list(SECTION_PATTERN.finditer(text))
+    for match, following in zip(matches, matches[1:] + [None]):
+        number = int(match.group(1))
+        end = following.start() if following is not None else len(text)
+        section = text[match.end():end].strip()
+        if 1 <= number <= count and section and number not in sections:
+            sections[number] = section
+    return sections
+
+def pack_items(items, capacity, max_items):
+    # First-fit decreasing: largest items first, each into the first bin
+    # with room left. Returns lists of items in their original order
+    bins = []
+    for item in sorted(items, key=lambda item: item.tokens, reverse=True):
+        for members in bins:
+            if len(members) < max_items and sum(member.tokens for member in members) + item.tokens <= capacity:
+                members.append(item)
+                break
+        else:
+            bins.append([item])
+    return [sorted(members, key=lambda item: item.index) for members in bins]
+
+class RequestPacker:
+    def __init__(self, async_client, template, temperature=0.1, counter=None, window=None,
+                 completion_tokens_per_item=None):
+        policy = PromptManager.get_metadata(template).get('packing')
+        if not policy:
+            raise ValueError(f"Template '{template}' has no packing policy")
+        self.client = async_client
+        self.config = async_client.client.config
+        self.template = template
+        self.temperature = temperature
+        self.counter = counter or default_counter
+        self.packed_template = policy['template']
+        self.variable = policy.get('variable', 'item')
+        self.max_items = policy.get('max_items', 8)
+        self.completion_tokens_per_item = (
+            completion_tokens_per_item or policy.get('completion_tokens_per_item', 250)
+        )
+        self.item_policy = PromptManager.get_metadata(template).get('budget')
+        self.packed_policy = PromptManager.get_metadata(self.packed_template).get('budget') or {}
+        # Rows considered together for packing; results stream out per window
+        self.window = window or async_client.concurrency * self.max_items * 2
+        self._static_names = PromptManager._entry(self.packed_template).variables - {'items'}
+        self._base_tokens = {}
+        self.requests = 0
+        self.packed_items = 0
+        self.retried_items = 0
+
+    def _static(self, variables):
+        return {name: variables[name] for name in self._static_names if name in variables}
+
+    def _capacity(self, static):
+        # Prompt tokens left for items once the packed preamble is rendered
+        key = json.dumps(static, sort_keys=True, default=repr)
+        if key not in self._base_tokens:
+            base = PromptManager.render_split(self.packed_template, counter=self.counter, items=[], **static)
+            self._base_tokens[key] = base.prompt_tokens
+        limit = self.packed_policy.get('max_prompt_tokens') or self.config.context_window or 0
+        return limit - self._base_tokens[key]
+
+    def _single_job(self, item):
+        try:
+            rendered = PromptManager.render_split(
+                self.template, context_window=self.config.context_window, counter=self.counter,
+                **item.variables
+            )
+        except ValueError as e:
+            return _Job(e, [item])
+        return _Job(self._payload(rendered), [item])
+
+    def _packed_job(self, static, members):
+        try:
+            rendered = PromptManager.render_split(
+                self.packed_template,
+                context_window=self.config.context_window,
+                max_tokens=self.completion_tokens_per_item * len(members),
+                counter=self.counter,
+                items=[member.variables[self.variable] for member in members],
+                **static
+            )
+        except ValueError:
+            return None
+        return _Job(self._payload(rendered), members)
+
+    def _payload(self, rendered):
+        return {
+            'model': self.config.model,
+            'temperature': self.temperature,
+            'max_tokens': rendered.max_tokens or 1000,
+            'messages': rendered.messages(),
+        }
+
+    def plan(self, rows):
+        # rows: (index, variables) pairs; returns the jobs to send
+        groups = {}
+        jobs = []
+        for index, variables in rows:
+            if isinstance(variables, Exception):
+                # A row that couldn't be read fails on its own, without a request
+                jobs.append(_Job(variables, [_Item(index, None, 0)]))
+                continue
+            # Items are cut down to the single template's budget first, so a
+            # packed item never carries more text than it would on its own
+            variables, _ = truncate_variables(variables, self.item_policy, self.counter)
+            item = _Item(index, variables, self.counter.count(str(variables.get(self.variable, ''))) + ITEM_OVERHEAD)
+            static = self._static(variables)
+            groups.setdefault(json.dumps(static, sort_keys=True, default=repr), (static, []))[1].append(item)
+
+        for static, items in groups.values():
+            try:
+                capacity = self._capacity(static)
+            except ValueError:
+                capacity = 0
+            for members in pack_items(items, capacity, self.max_items):
+                job = self._packed_job(static, members) if len(members) > 1 else None
+                if job is None:
+                    jobs.extend(self._single_job(member) for member in members)
+                else:
+                    jobs.append(job)
+        return jobs
+
+    async def _send(self, jobs):
+        # Yields (job, content or exception) as responses arrive
+        self.requests += sum(not isinstance(job.payload, Exception) for job in jobs)
+        async for position, result in self.client.complete_many((job.payload for job in jobs), template=self.template):
+            yield jobs[position], result
+
+    async def run(self, rows):
+        # Async generator of (index, content or exception), in completion order
+        rows = iter(rows)
+        while True:
+            window = list(islice(rows, self.window))
+            if not window:
+                return
+            retry = []
+            async for job, result in self._send(self.plan(window)):
+                if len(job.items) == 1:
+                    yield job.items[0].index, result
+                    continue
+                sections = {} if isinstance(result, Exception) else split_packed_response(result, len(job.items))
+                for number, item in enumerate(job.items, start=1):
+                    if number in sections:
+                        self.packed_items += 1
+                        yield item.index, sections[number]
+                    else:
+                        retry.append(item)
+            self.retried_items += len(retry)
+            async for job, result in self._send([self._single_job(item) for item in retry]):
+                yield job.items[0].index, result
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# --------------------------------------------------------------
+# Persistent cache for deterministic completions
+# --------------------------------------------------------------
+# Responses are stored in SQLite under a hash of the canonical payload.
+# Only low-temperature, non-streaming calls are cached: higher temperatures
+# (like the 0.7 tree-of-thoughts example) are meant to vary between calls.
+
+class ResponseCache:
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=100 * 1024 * 1024, max_temperature=0.1):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # WAL without fsync on every commit keeps hits (which update the
+        # access time) in the tens of microseconds
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(payload):
+        canonical = json.dumps(
+            {
+                'model': payload.get('model'),
+                'messages': payload.get('messages'),
+                'temperature': payload.get('temperature'),
+                'max_tokens': payload.get('max_tokens'),
+            },
+            sort_keys=True,
+            separators=(',', ':'),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def cacheable(self, payload):
+        temperature = payload.get('temperature')
+        return (
+            not payload.get('stream')
+            and temperature is not None
+            and temperature <= self.max_temperature
+        )
+
+    def get(self, payload):
+        key = self.make_key(payload)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, payload, response_data):
+        key = self.make_key(payload)
+        response = json.dumps(response_data, separators=(',', ':'))
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            self._total_bytes += size - (previous[0] if previous else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop expired rows, then least recently used ones until 90% full so
+        # eviction runs in batches rather than on every insert
+        self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        target = self.max_bytes * 0.9
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > target:
+            cursor = self._db.execute("SELECT key, size FROM responses ORDER BY accessed")
+            evicted = []
+            for key, size in cursor:
+                if total <= target:
+                    break
+                evicted.append((key,))
+                total -= size
+            self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._total_bytes = total
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': entries,
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
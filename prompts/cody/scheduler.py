@@ -0,0 +1,128 @@
+import email.utils
+import random
+import threading
+import time
+import requests
+from token_budget import default_counter
+
+# --------------------------------------------------------------
+# Client-side rate limiting and retries for completions requests
+# --------------------------------------------------------------
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    # Refills continuously at rate_per_minute up to capacity (one minute's
+    # worth by default). reserve() takes the amount immediately, letting the
+    # balance go negative, and returns how long the caller must wait before
+    # sending. Waiting callers therefore queue in order instead of racing.
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def wait_time(self, amount=1):
+        # What reserve(amount) would return, without taking anything
+        amount = min(amount, self.capacity)
+        with self._lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return max(0.0, amount - tokens) / self.rate
+
+def estimate_tokens(payload):
+    # Upper bound of what a request costs against a tokens/minute quota:
+    # the prompt plus the whole completion budget
+    return (payload.get('max_tokens') or 0) + default_counter.count_messages(payload.get('messages', []))
+
+def parse_retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=3,
+                 backoff_base=0.5, backoff_max=30.0, retry_statuses=RETRY_STATUSES,
+                 sleep=time.sleep):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = retry_statuses
+        self.sleep = sleep
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, payload):
+        # Seconds to wait before `payload` may be sent under both limits
+        delay = 0.0
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.reserve(estimate_tokens(payload)))
+        return delay
+
+    def try_acquire(self, payload):
+        # Reserves `payload` under both limits only if it can be sent right
+        # away, for extra requests (hedges) that aren't worth waiting for
+        tokens = estimate_tokens(payload) if self.token_bucket is not None else 0
+        with self._lock:
+            if self.request_bucket is not None and self.request_bucket.wait_time(1):
+                return False
+            if self.token_bucket is not None and self.token_bucket.wait_time(tokens):
+                return False
+            self.acquire(payload)
+        return True
+
+    def backoff(self, attempt, retry_after=None):
+        # The server's Retry-After wins; otherwise exponential backoff with
+        # full jitter so clients that failed together don't retry together
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def is_retryable(self, error):
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        return getattr(error, 'status_code', None) in self.retry_statuses
+
+    def call(self, send, payload):
+        attempt = 0
+        while True:
+            delay = self.acquire(payload)
+            if delay:
+                with self._lock:
+                    self.throttled_seconds += delay
+                self.sleep(delay)
+            try:
+                return send(payload)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    raise
+                with self._lock:
+                    self.retries += 1
+                self.sleep(self.backoff(attempt, getattr(e, 'retry_after', None)))
+                attempt += 1
@@ -0,0 +1,93 @@
+import asyncio
+import re
+from collections import Counter, namedtuple
+
+# --------------------------------------------------------------
+# Self-consistency for chain-of-thought prompts
+# --------------------------------------------------------------
+# Several reasoning paths are sampled at a higher temperature and the final
+# answer extracted from each one is put to a majority vote. Samples are sent
+# concurrently; once the leading answer is ahead by `vote_margin` votes (or
+# can no longer be overtaken) the remaining samples are cancelled.
+
+ConsistencyResult = namedtuple(
+    'ConsistencyResult',
+    ['answer', 'votes', 'samples', 'stopped_early', 'paths'],
+)
+
+NUMBER_PATTERN = re.compile(r'-?\d+(?:[.,]\d+)*')
+ANSWER_PATTERN = re.compile(r'(?:final answer|answer)\s*(?:is|:)\s*\**\s*([^\n]+)', re.IGNORECASE)
+
+def normalize_answer(answer):
+    return answer.strip().strip('*.').strip().lower()
+
+def parse_last_number(text):
+    numbers = NUMBER_PATTERN.findall(text or '')
+    return numbers[-1].replace(',', '') if numbers else None
+
+def parse_final_answer(text):
+    # "Final answer: 7" / "The answer is 7"; falls back to the last number
+    matches = ANSWER_PATTERN.findall(text or '')
+    if matches:
+        return normalize_answer(matches[-1])
+    return parse_last_number(text)
+
+ANSWER_PARSERS = {
+    'final_answer': parse_final_answer,
+    'last_number': parse_last_number,
+}
+
+class SelfConsistency:
+    def __init__(self, async_client, samples=10, parallel=5, temperature=0.7, max_tokens=1000,
+                 parser=parse_final_answer, vote_margin=3):
+        self.client = async_client
+        self.samples = samples
+        self.parallel = parallel
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.parser = ANSWER_PARSERS[parser] if isinstance(parser, str) else parser
+        self.vote_margin = vote_margin
+
+    def _settled(self, votes, remaining):
+        ranked = votes.most_common(2)
+        if not ranked:
+            return False
+        lead = ranked[0][1] - (ranked[1][1] if len(ranked) > 1 else 0)
+        return lead >= self.vote_margin or lead > remaining
+
+    async def run(self, messages):
+        payload = self.client.build_payload(messages, temperature=self.temperature, max_tokens=self.max_tokens)
+        # Only `parallel` samples are in flight at once, so an early stop
+        # cancels the queued ones before they are ever sent
+        semaphore = asyncio.Semaphore(self.parallel)
+
+        async def sample():
+            async with semaphore:
+                return await self.client.complete_payload(payload)
+
+        tasks = [asyncio.ensure_future(sample()) for _ in range(self.samples)]
+        votes = Counter()
+        paths = []
+        finished = 0
+        stopped_early = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    text = await next_done
+                except Exception:
+                    text = None
+                finished += 1
+                answer = self.parser(text) if text else None
+                paths.append((answer, text))
+                if answer is not None:
+                    votes[answer] += 1
+                if finished < self.samples and self._settled(votes, self.samples - finished):
+                    stopped_early = True
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        answer = votes.most_common(1)[0][0] if votes else None
+        return ConsistencyResult(answer, dict(votes), finished, stopped_early, paths)
@@ -0,0 +1,100 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+
+# --------------------------------------------------------------
+# Single-flight: one request per identical in-flight payload
+# --------------------------------------------------------------
+# When several callers send the same payload at the same time (many workers
+# rendering the same FAQ-style prompt), only the first one goes to the
+# endpoint; the others wait for it and receive a copy of its response, or its
+# error. Only deterministic payloads are shared: identical requests at a
+# higher temperature (self-consistency samples, tree-of-thoughts proposals)
+# are meant to produce different answers and are always sent.
+
+def payload_key(payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def is_deterministic(payload, max_temperature):
+    temperature = payload.get('temperature')
+    return not payload.get('stream') and temperature is not None and temperature <= max_temperature
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    # For threads sharing one CompletionsClient
+    def __init__(self, max_temperature=0.1):
+        self.max_temperature = max_temperature
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, payload, function):
+        # Returns (result, shared); shared is True when another caller's
+        # request was reused
+        if not is_deterministic(payload, self.max_temperature):
+            return function(), False
+        key = payload_key(payload)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            with self._lock:
+                self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+class AsyncSingleFlight:
+    # For coroutines on one event loop; waiting callers don't hold a
+    # concurrency slot or an executor thread
+    def __init__(self, max_temperature=0.1):
+        self.max_temperature = max_temperature
+        self.shared = 0
+        self._tasks = {}
+
+    def _forget(self, key, task):
+        self._tasks.pop(key, None)
+        # Mark the outcome as retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, payload, factory):
+        # factory: zero-argument callable returning the coroutine to share
+        if not is_deterministic(payload, self.max_temperature):
+            return await factory(), False
+        key = payload_key(payload)
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda task: self._forget(key, task))
+        # A cancelled caller must not cancel the request others are waiting on
+        result = await asyncio.shield(task)
+        return (copy.deepcopy(result) if shared else result), shared
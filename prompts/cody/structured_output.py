@@ -0,0 +1,198 @@
+import json
+import re
+
+# --------------------------------------------------------------
+# Structured output: JSON answers parsed while they stream
+# --------------------------------------------------------------
+# A template opts in by declaring the JSON schema of its answer in the
+# frontmatter, e.g. ticket_analysis:
+#
+#   output_schema:
+#     type: object
+#     properties:
+#       intent: {type: string}
+#       confidence: {type: number}
+#       reasoning: {type: string}
+#     required: [intent, confidence]
+#
+# PromptManager.render_split(..., structured=True) appends instructions to
+# answer with one JSON object, required fields first. IncrementalJSONParser
+# reads that object delta by delta and reports every top-level field the
+# moment its value is complete, so CompletionsClient.stream_structured can
+# route on `intent` and `confidence` and close the stream before the model
+# spends time and tokens on fields nobody will read.
+
+class StructuredOutputError(ValueError):
+    pass
+
+def field_order(schema):
+    # Required fields in the order `required` lists them, then the rest. The
+    # properties mapping itself can't be relied on for order: the template
+    # registry stores frontmatter with sorted keys
+    required = list(schema.get('required', ()))
+    return required + [name for name in schema.get('properties', {}) if name not in required]
+
+def format_instructions(schema):
+    fields = ', '.join(f'"{name}"' for name in field_order(schema))
+    return (
+        "# OUTPUT FORMAT\n"
+        "Respond with a single JSON object and nothing else: no code fences, no text before or after it. "
+        f"Write its fields in this order: {fields}.\n"
+        f"JSON schema: {json.dumps(schema, separators=(',', ':'))}"
+    )
+
+_TYPES = {
+    'string': str,
+    'number': (int, float),
+    'integer': int,
+    'boolean': bool,
+    'array': list,
+    'object': dict,
+    'null': type(None),
+}
+
+def validate_fields(schema, fields, required=None):
+    # Checks the fields that matter for routing: required names present, and
+    # the declared type and enum of every field given. Not a full JSON Schema
+    # validator
+    required = schema.get('required', ()) if required is None else required
+    missing = [name for name in required if name not in fields]
+    if missing:
+        raise StructuredOutputError(f"Structured output is missing {', '.join(missing)}")
+    for name, value in fields.items():
+        spec = schema.get('properties', {}).get(name, {})
+        expected = spec.get('type')
+        if expected in _TYPES and (
+            not isinstance(value, _TYPES[expected])
+            or (isinstance(value, bool) and expected in ('number', 'integer'))
+        ):
+            raise StructuredOutputError(f"Field '{name}' should be of type {expected}, got {value!r}")
+        if 'enum' in spec and value not in spec['enum']:
+            raise StructuredOutputError(f"Field '{name}' should be one of {spec['enum']}, got {value!r}")
+
+# Characters that end the plain run inside a JSON string
+_STRING_SPECIAL = re.compile(r'["\\]')
+_WHITESPACE = ' \t\r\n'
+
+class IncrementalJSONParser:
+    # Parses one top-level JSON object fed in arbitrary pieces. feed() returns
+    # the (name, value) pairs completed by that piece: strings and containers
+    # as soon as they close, numbers and literals at the next delimiter.
+    # Anything before the opening brace (a stray code fence) is skipped.
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._state = 'start'
+        self._key = None
+        self._value = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _complete(self, completed):
+        text = ''.join(self._value)
+        try:
+            value = json.loads(text)
+        except ValueError:
+            raise StructuredOutputError(f"Invalid value for field '{self._key}': {text!r}")
+        self.fields[self._key] = value
+        completed.append((self._key, value))
+        self._value = []
+        self._state = 'after_value'
+
+    def _scan_string(self, chunk, i):
+        # Consumes string characters from chunk[i:]; returns the index after
+        # the closing quote, or len(chunk) if the string continues
+        while i < len(chunk):
+            if self._escape:
+                self._value.append(chunk[i])
+                self._escape = False
+                i += 1
+                continue
+            match = _STRING_SPECIAL.search(chunk, i)
+            if match is None:
+                self._value.append(chunk[i:])
+                return len(chunk)
+            end = match.start()
+            self._value.append(chunk[i:end + 1])
+            i = end + 1
+            if chunk[end] == '\\':
+                self._escape = True
+            else:
+                self._in_string = False
+                return i
+        return i
+
+    def feed(self, chunk):
+        completed = []
+        i = 0
+        while i < len(chunk):
+            state = self._state
+            char = chunk[i]
+            if state == 'start':
+                start = chunk.find('{', i)
+                if start < 0:
+                    return completed
+                self._state = 'key_or_end'
+                i = start + 1
+            elif state in ('key_or_end', 'after_value'):
+                if char in _WHITESPACE:
+                    i += 1
+                elif char == '}':
+                    self._state = 'done'
+                    self.done = True
+                    i += 1
+                elif char == ',' and state == 'after_value':
+                    self._state = 'key_or_end'
+                    i += 1
+                elif char == '"' and state == 'key_or_end':
+                    self._state = 'key'
+                    self._value = ['"']
+                    self._in_string = True
+                    i += 1
+                else:
+                    raise StructuredOutputError(f"Unexpected {char!r} in structured output")
+            elif state == 'key':
+                i = self._scan_string(chunk, i)
+                if not self._in_string:
+                    self._key = json.loads(''.join(self._value))
+                    self._value = []
+                    self._state = 'colon'
+            elif state == 'colon':
+                if char == ':':
+                    self._state = 'value'
+                elif char not in _WHITESPACE:
+                    raise StructuredOutputError(f"Expected ':' after '{self._key}', got {char!r}")
+                i += 1
+            elif state == 'value':
+                if not self._value and char in _WHITESPACE:
+                    i += 1
+                elif self._in_string:
+                    i = self._scan_string(chunk, i)
+                    if not self._in_string and not self._depth:
+                        self._complete(completed)
+                elif char == '"':
+                    self._value.append(char)
+                    self._in_string = True
+                    i += 1
+                elif char in '{[':
+                    self._value.append(char)
+                    self._depth += 1
+                    i += 1
+                elif char in '}]' and self._depth:
+                    self._value.append(char)
+                    self._depth -= 1
+                    i += 1
+                    if not self._depth:
+                        self._complete(completed)
+                elif not self._depth and (char in ',}' or char in _WHITESPACE):
+                    # The end of a number or literal; the delimiter itself is
+                    # handled in the after_value state
+                    self._complete(completed)
+                else:
+                    self._value.append(char)
+                    i += 1
+            else:
+                # Anything after the closing brace is ignored
+                return completed
+        return completed
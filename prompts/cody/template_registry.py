@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from jinja2 import TemplateNotFound, meta, nodes
+
+INDEX_VERSION = 1
+
+# Same delimiter python-frontmatter uses for YAML frontmatter
+FRONTMATTER_BOUNDARY = re.compile(r"^-{3,}\s*$", re.MULTILINE)
+
+def split_frontmatter(text):
+    # Splits a template into its raw frontmatter block and its body without
+    # importing frontmatter/YAML; the body matches frontmatter.loads().content
+    text = text.strip()
+    if FRONTMATTER_BOUNDARY.match(text):
+        parts = FRONTMATTER_BOUNDARY.split(text, 2)
+        if len(parts) == 3:
+            return parts[1], parts[2].strip()
+    return "", text
+
+def parse_frontmatter(header):
+    # YAML is only imported once some caller actually asks for metadata
+    if not header.strip():
+        return {}
+    import yaml
+    metadata = yaml.safe_load(header)
+    return metadata if isinstance(metadata, dict) else {}
+
+def find_required_variables(ast, variables):
+    # Undeclared variables that are used at least once without a `default`
+    # filter; the rest have a fallback and may be omitted when rendering
+    defaulted = {
+        id(node.node)
+        for node in ast.find_all(nodes.Filter)
+        if node.name in ("default", "d") and isinstance(node.node, nodes.Name)
+    }
+    return frozenset(
+        node.name
+        for node in ast.find_all(nodes.Name)
+        if node.ctx == "load" and node.name in variables and id(node) not in defaulted
+    )
+
+def find_macros(ast):
+    # Top-level macros a template exports, e.g. concept/language/pattern in prompts.j2
+    return {
+        node.name: [arg.name for arg in node.args]
+        for node in ast.body
+        if isinstance(node, nodes.Macro)
+    }
+
+# Top-level statements whose effects (assignments, macros, imports,
+# inheritance) can reach past a split point
+_STATEFUL_NODES = (
+    nodes.Assign, nodes.AssignBlock, nodes.Macro, nodes.CallBlock, nodes.Import,
+    nodes.FromImport, nodes.Include, nodes.Extends, nodes.Block,
+)
+
+def _references(node, names):
+    found = node.find_all(nodes.Name)
+    if isinstance(node, nodes.Name):
+        found = [node, *found]
+    return any(name.ctx == "load" and name.name in names for name in found)
+
+def split_static_prefix(ast, dynamic):
+    # Splits a template body before the first output that depends on one of
+    # the `dynamic` variables. Rendering the prefix (which only needs the
+    # static variables) followed by the tail gives the whole template. The
+    # cut is moved back to the last paragraph break before the dynamic value,
+    # so a heading such as "# INPUT" stays with it. Returns (prefix, tail)
+    # Template nodes, or None when no static prefix can be split off safely.
+    dynamic = set(dynamic)
+    prefix = []
+    tail = []
+    for position, node in enumerate(ast.body):
+        if isinstance(node, _STATEFUL_NODES) or any(True for _ in node.find_all(_STATEFUL_NODES)):
+            return None
+        if not _references(node, dynamic):
+            prefix.append(node)
+            continue
+        tail = ast.body[position + 1:]
+        if not isinstance(node, nodes.Output):
+            tail = [node, *tail]
+            break
+        split_at = next(index for index, child in enumerate(node.nodes) if _references(child, dynamic))
+        head, rest = node.nodes[:split_at], node.nodes[split_at:]
+        if head and isinstance(head[-1], nodes.TemplateData) and "\n\n" in head[-1].data:
+            data = head[-1].data
+            cut = data.rindex("\n\n")
+            head = head[:-1] + [nodes.TemplateData(data[:cut], lineno=head[-1].lineno)]
+            rest = [nodes.TemplateData(data[cut:], lineno=rest[0].lineno), *rest]
+        if head:
+            prefix.append(nodes.Output(head, lineno=node.lineno))
+        tail = [nodes.Output(rest, lineno=node.lineno), *tail]
+        break
+    if not prefix:
+        return None
+    return (
+        nodes.Template(prefix, lineno=1).set_environment(ast.environment),
+        nodes.Template(tail, lineno=1).set_environment(ast.environment),
+    )
+
+class TemplateRegistry:
+    # Index of every template in a directory: metadata, variables, macros and
+    # a content hash. The index is persisted next to the templates and only
+    # files whose mtime/size and hash changed are parsed again.
+    def __init__(self, templates_dir, env, index_path=None):
+        self.templates_dir = Path(templates_dir)
+        self.env = env
+        self.index_path = Path(index_path) if index_path else self.templates_dir / ".template_index.json"
+        self._lock = threading.Lock()
+        self._index = self._read_index()
+        self.refresh()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != INDEX_VERSION:
+            return {}
+        return data.get("templates", {})
+
+    def _write_index(self):
+        data = {"version": INDEX_VERSION, "templates": self._index}
+        tmp_path = self.index_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(data, file, indent=2, sort_keys=True, default=str)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # A read-only templates directory just means no persisted index
+            pass
+
+    def _build_entry(self, name, path, stat, raw, digest):
+        header, content = split_frontmatter(raw.decode("utf-8"))
+        metadata = parse_frontmatter(header)
+        ast = self.env.parse(content)
+        variables = meta.find_undeclared_variables(ast)
+        return {
+            "name": name,
+            "path": str(path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "digest": digest,
+            "description": metadata.get("description", "No description provided"),
+            "author": metadata.get("author", "Unknown"),
+            "variables": sorted(variables),
+            "required_variables": sorted(find_required_variables(ast, variables)),
+            "macros": find_macros(ast),
+            "frontmatter": metadata,
+        }
+
+    def _update(self, name, path, stat):
+        # Returns True when the index entry changed
+        entry = self._index.get(name)
+        if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return False
+        with open(path, "rb") as file:
+            raw = file.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if entry and entry["digest"] == digest:
+            entry["mtime_ns"] = stat.st_mtime_ns
+            entry["size"] = stat.st_size
+        else:
+            self._index[name] = self._build_entry(name, path, stat, raw, digest)
+        return True
+
+    def refresh(self):
+        with self._lock:
+            changed = False
+            seen = set()
+            for dir_entry in os.scandir(self.templates_dir):
+                if not dir_entry.is_file() or not dir_entry.name.endswith(".j2"):
+                    continue
+                name = dir_entry.name[:-len(".j2")]
+                seen.add(name)
+                changed |= self._update(name, dir_entry.path, dir_entry.stat())
+            for name in set(self._index) - seen:
+                del self._index[name]
+                changed = True
+            if changed:
+                self._write_index()
+
+    def get(self, name):
+        # Single-file freshness check, so callers never see a stale entry
+        path = self.templates_dir / f"{name}.j2"
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._index.pop(name, None)
+                raise TemplateNotFound(f"{name}.j2")
+            if self._update(name, path, stat):
+                self._write_index()
+            return self._index[name]
+
+    def list_templates(self):
+        # A directory scan plus one stat per template, so templates added or
+        # deleted since startup are reflected, like get() does for one file
+        self.refresh()
+        with self._lock:
+            return [dict(self._index[name]) for name in sorted(self._index)]
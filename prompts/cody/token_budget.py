@@ -0,0 +1,152 @@
+import re
+from collections import namedtuple
+from jinja2 import TemplateError
+
+# --------------------------------------------------------------
+# Local token counting and prompt budgets
+# --------------------------------------------------------------
+# Prompts are measured before they are sent so that oversize requests fail
+# locally instead of after a network round trip. Without a real tokenizer the
+# count is a byte-pair approximation: text is split the way GPT-style
+# tokenizers pre-tokenize it and every piece costs about one token per four
+# characters.
+
+PIECE_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+", re.UNICODE)
+
+# Tokens the chat format adds around every message and the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 2
+
+ELISION_MARKER = "\n[...]\n"
+
+BudgetedPrompt = namedtuple('BudgetedPrompt', ['text', 'prompt_tokens', 'max_tokens', 'truncated'])
+
+class PromptBudgetError(ValueError):
+    pass
+
+def approximate_token_count(text):
+    count = 0
+    for piece in PIECE_PATTERN.findall(text):
+        count += (len(piece) + 3) // 4
+    return count
+
+class TokenCounter:
+    def __init__(self, tokenizer=None):
+        # tokenizer: callable returning the number of tokens in a string
+        self.tokenizer = tokenizer or approximate_token_count
+
+    @classmethod
+    def from_tiktoken(cls, encoding_name="cl100k_base"):
+        # Exact counts when tiktoken is installed, the approximation otherwise
+        try:
+            import tiktoken
+        except ImportError:
+            return cls()
+        encoding = tiktoken.get_encoding(encoding_name)
+        return cls(lambda text: len(encoding.encode(text, disallowed_special=())))
+
+    def count(self, text):
+        return self.tokenizer(text) if text else 0
+
+    def count_messages(self, messages):
+        return REPLY_OVERHEAD + sum(
+            MESSAGE_OVERHEAD + self.count(message.get('content') or '') for message in messages
+        )
+
+    def _prefix(self, text, max_tokens):
+        # Longest prefix within max_tokens; binary search works with any tokenizer
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+    def _suffix(self, text, max_tokens):
+        return self._prefix(text[::-1], max_tokens)[::-1]
+
+    def truncate(self, text, max_tokens, strategy="truncate"):
+        # "truncate" keeps the start; "elide" keeps the start and the end and
+        # drops the middle, which preserves sign-offs and closing questions
+        if self.count(text) <= max_tokens:
+            return text
+        if strategy == "elide":
+            budget = max(0, max_tokens - self.count(ELISION_MARKER))
+            return self._prefix(text, budget - budget // 2) + ELISION_MARKER + self._suffix(text, budget // 2)
+        if strategy == "truncate":
+            return self._prefix(text, max_tokens)
+        raise ValueError(f"Unknown truncation strategy: {strategy}")
+
+default_counter = TokenCounter()
+
+def set_tokenizer(tokenizer):
+    default_counter.tokenizer = tokenizer or approximate_token_count
+
+def fit_max_tokens(prompt_tokens, max_tokens=None, context_window=None, min_completion_tokens=1):
+    # Shrinks max_tokens to what the context window leaves after the prompt
+    if not context_window:
+        return max_tokens
+    available = context_window - prompt_tokens
+    if available < min_completion_tokens:
+        raise PromptBudgetError(
+            f"Prompt needs {prompt_tokens} tokens, leaving {max(available, 0)} of the "
+            f"{context_window}-token context window (need at least {min_completion_tokens})"
+        )
+    return available if max_tokens is None else min(max_tokens, available)
+
+def fit_payload(payload, context_window, counter=None):
+    # Returns the payload with max_tokens sized to the context window, or
+    # raises PromptBudgetError when the prompt alone doesn't fit
+    counter = counter or default_counter
+    prompt_tokens = counter.count_messages(payload.get('messages', []))
+    max_tokens = fit_max_tokens(prompt_tokens, payload.get('max_tokens'), context_window)
+    if max_tokens != payload.get('max_tokens'):
+        payload = dict(payload, max_tokens=max_tokens)
+    return payload
+
+def truncate_variables(variables, policy=None, counter=None):
+    # Cuts string variables down to their per-variable budget; returns the
+    # new variables and the names that were truncated
+    counter = counter or default_counter
+    truncated = []
+    variables = dict(variables)
+    for name, rule in ((policy or {}).get('variables') or {}).items():
+        value = variables.get(name)
+        if isinstance(value, str) and counter.count(value) > rule['max_tokens']:
+            variables[name] = counter.truncate(value, rule['max_tokens'], rule.get('strategy', 'truncate'))
+            truncated.append(name)
+    return variables, truncated
+
+def fit_policy(prompt_tokens, policy=None, context_window=None, max_tokens=None):
+    # Enforces the policy's prompt limit and returns the fitted max_tokens
+    policy = policy or {}
+    max_prompt_tokens = policy.get('max_prompt_tokens')
+    if max_prompt_tokens and prompt_tokens > max_prompt_tokens:
+        raise PromptBudgetError(f"Prompt needs {prompt_tokens} tokens, the template allows {max_prompt_tokens}")
+
+    return fit_max_tokens(
+        prompt_tokens,
+        max_tokens or policy.get('max_tokens'),
+        context_window or policy.get('context_window'),
+        policy.get('min_completion_tokens', 1),
+    )
+
+def render_within_budget(compiled, variables, policy=None, counter=None, context_window=None, max_tokens=None):
+    # policy comes from the template frontmatter:
+    #   budget:
+    #     max_prompt_tokens: 3000
+    #     max_tokens: 1000
+    #     min_completion_tokens: 200
+    #     variables:
+    #       ticket: {max_tokens: 2000, strategy: elide}
+    counter = counter or default_counter
+    variables, truncated = truncate_variables(variables, policy, counter)
+    try:
+        text = compiled.render(**variables)
+    except TemplateError as e:
+        raise ValueError(f"Error rendering template: {str(e)}")
+    prompt_tokens = counter.count_messages([{'content': text}])
+    max_tokens = fit_policy(prompt_tokens, policy, context_window, max_tokens)
+    return BudgetedPrompt(text, prompt_tokens, max_tokens, truncated)
@@ -0,0 +1,118 @@
+import asyncio
+import re
+from collections import namedtuple
+from prompt_manager import PromptManager
+from scheduler import estimate_tokens
+
+# --------------------------------------------------------------
+# Tree of Thoughts search with concurrent branches
+# --------------------------------------------------------------
+# Each level of the tree is one round trip: all candidate thoughts for the
+# current beam are generated concurrently, then all of them are scored
+# concurrently, and only the best `beam_width` survive to the next level.
+# Wall-clock time therefore grows with depth, not with the number of branches.
+
+ThoughtNode = namedtuple('ThoughtNode', ['steps', 'score'])
+
+TreeResult = namedtuple('TreeResult', ['best', 'answer', 'levels', 'requests', 'tokens_used'])
+
+SCORE_PATTERN = re.compile(r'\b(10(?:\.0+)?|[0-9](?:\.\d+)?)\b')
+
+def parse_score(text):
+    match = SCORE_PATTERN.search(text or '')
+    return float(match.group(1)) if match else 0.0
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+class TreeOfThoughts:
+    def __init__(self, async_client, breadth=3, depth=2, beam_width=2, token_budget=20000,
+                 temperature=0.7, thought_max_tokens=300, eval_max_tokens=10, answer_max_tokens=1000):
+        self.client = async_client
+        self.breadth = breadth
+        self.depth = depth
+        self.beam_width = beam_width
+        self.token_budget = token_budget
+        self.temperature = temperature
+        self.thought_max_tokens = thought_max_tokens
+        self.eval_max_tokens = eval_max_tokens
+        self.answer_max_tokens = answer_max_tokens
+        self.macros = PromptManager.get_macros('tree_of_thoughts')
+        self.tokens_used = 0
+        self.requests = 0
+
+    def _payload(self, prompt, temperature, max_tokens):
+        return self.client.build_payload(prompt, temperature=temperature, max_tokens=max_tokens)
+
+    def _reserve(self, cost, requests):
+        # Reserve the estimated worst-case cost of a whole level up front so a
+        # level either fits in the budget or isn't started at all
+        if self.tokens_used + cost > self.token_budget:
+            raise TokenBudgetExceeded(
+                f"Next step needs ~{cost} tokens, {self.token_budget - self.tokens_used} left"
+            )
+        self.tokens_used += cost
+        self.requests += requests
+
+    async def _complete_all(self, payloads):
+        # Failed branches come back as None and are pruned instead of failing the tree
+        async def complete(payload):
+            try:
+                return await self.client.complete_payload(payload)
+            except Exception:
+                return None
+        return await asyncio.gather(*(complete(payload) for payload in payloads))
+
+    async def _expand(self, problem, frontier):
+        payloads = [
+            self._payload(self.macros['propose'](problem, node.steps), self.temperature, self.thought_max_tokens)
+            for node in frontier
+            for _ in range(self.breadth)
+        ]
+        # Each candidate is later scored with a prompt about as long as its
+        # propose prompt plus the new thought, so the level costs roughly twice
+        # the propose estimate
+        cost = sum(2 * estimate_tokens(payload) + self.eval_max_tokens for payload in payloads)
+        self._reserve(cost, 2 * len(payloads))
+        thoughts = await self._complete_all(payloads)
+        parents = [node for node in frontier for _ in range(self.breadth)]
+        return [
+            parent.steps + [thought.strip()]
+            for parent, thought in zip(parents, thoughts)
+            if thought and thought.strip()
+        ]
+
+    async def _evaluate(self, problem, candidates):
+        payloads = [
+            self._payload(self.macros['evaluate'](problem, steps), 0.0, self.eval_max_tokens)
+            for steps in candidates
+        ]
+        scores = await self._complete_all(payloads)
+        return [ThoughtNode(steps, parse_score(score)) for steps, score in zip(candidates, scores)]
+
+    async def solve(self, problem, conclude=True):
+        self.tokens_used = 0
+        self.requests = 0
+        frontier = [ThoughtNode([], 0.0)]
+        levels = 0
+        try:
+            for _ in range(self.depth):
+                candidates = await self._expand(problem, frontier)
+                if not candidates:
+                    break
+                scored = await self._evaluate(problem, candidates)
+                frontier = sorted(scored, key=lambda node: node.score, reverse=True)[:self.beam_width]
+                levels += 1
+        except TokenBudgetExceeded:
+            pass
+
+        best = frontier[0]
+        answer = None
+        if conclude and best.steps:
+            payload = self._payload(self.macros['conclude'](problem, best.steps), 0.1, self.answer_max_tokens)
+            try:
+                self._reserve(estimate_tokens(payload), 1)
+                answer = (await self._complete_all([payload]))[0]
+            except TokenBudgetExceeded:
+                pass
+        return TreeResult(best, answer, levels, self.requests, self.tokens_used)